@@ -0,0 +1,329 @@
+# coding: utf-8
+"""
+Snooze Benchmarks
+
+Drive Snooze through the Flask test client and as a bare WSGI app, against an
+in-memory endpoint and a SQLite backed SqlAlchemyEndpoint, timing each verb
+for a range of collection sizes along with the cost of serialization.
+
+Results are written as JSON, to be compared between commits:
+
+    python benchmarks/bench_snooze.py --sizes 10,1000,100000 -o before.json
+    python benchmarks/bench_snooze.py --sizes 10,1000,100000 -o after.json
+    python benchmarks/bench_snooze.py --compare before.json after.json
+"""
+from flask import Flask
+from flask.ext.sqlalchemy import SQLAlchemy
+from flask.ext.snooze import Snooze, Endpoint, SqlAlchemyEndpoint, \
+    NotFoundError
+from werkzeug.test import EnvironBuilder
+from datetime import datetime
+from itertools import count
+import argparse
+import os
+import platform
+import subprocess
+import time
+import sys
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+#
+# Backends
+#
+
+
+class Item(object):
+
+    def __init__(self, id):
+        self.id = id
+        self.name = None
+        self.value = None
+
+    def __iter__(self):
+        return iter(self.__dict__.items())
+
+
+class MemoryEndpoint(Endpoint):
+
+    """
+    Keep objects in a dict, leaving reads of many, keys, chunks and partial
+    reads to the Endpoint defaults.
+    """
+
+    def __init__(self, size):
+        super(MemoryEndpoint, self).__init__(Item, 'id', ['name', 'value'],
+                                             ['id', 'name'], ['id', 'name'])
+        self.objects = {}
+        for i in xrange(1, size + 1):
+            self.objects[i] = self._item(i)
+        self._ids = count(size + 1)
+
+    def _item(self, i):
+        o = Item(i)
+        o.name = u'item %d' % i
+        o.value = i * 2
+        return o
+
+    def create(self, path=None):
+        return Item(self._ids.next() if path is None else int(path))
+
+    def read(self, path):
+        if path is None:
+            return sorted(self.objects)
+        try:
+            return self.objects[int(path)]
+        except (KeyError, ValueError):
+            raise NotFoundError(Item, path)
+
+    def finalize(self, obj):
+        self.objects[obj.id] = obj
+
+    def delete(self, path):
+        try:
+            del self.objects[int(path)]
+        except (KeyError, ValueError):
+            raise NotFoundError(Item, path)
+
+
+def memory_app(size):
+    """Construct an app serving an in-memory collection of size items"""
+    app = Flask(__name__)
+    Snooze(app).add(MemoryEndpoint(size), name='item')
+    return app
+
+
+def sqlalchemy_app(size):
+    """Construct an app serving a SQLite table of size rows"""
+    return sqlalchemy_snooze(size)[0]
+
+
+def sqlalchemy_snooze(size):
+    """
+    Construct an app serving a SQLite table of size rows, giving the app, its
+    Snooze and the endpoint
+    """
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db = SQLAlchemy(app)
+
+    class Item(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        created = db.Column(db.DateTime, default=datetime.utcnow)
+        name = db.Column(db.String(80), index=True)
+        value = db.Column(db.Integer)
+
+    with app.test_request_context():
+        db.create_all()
+        now = datetime.utcnow()
+        for start in xrange(1, size + 1, 10000):
+            db.session.execute(Item.__table__.insert(), [
+                dict(id=i, created=now, name=u'item %d' % i, value=i * 2)
+                for i in xrange(start, min(start + 10000, size + 1))])
+        db.session.commit()
+
+    snooze = Snooze(app)
+    endpoint = SqlAlchemyEndpoint(db, Item, ['name', 'value'])
+    snooze.add(endpoint)
+    return app, snooze, endpoint
+
+
+BACKENDS = dict(memory=memory_app, sqlalchemy=sqlalchemy_app)
+
+#
+# Drivers
+#
+
+
+def client_driver(app):
+    """Make requests through the Flask test client"""
+    client = app.test_client()
+
+    def request(method, path, data=None):
+        r = client.open(path, method=method, data=data,
+                        content_type='application/json')
+        return r.status_code
+    return request
+
+
+def wsgi_driver(app):
+    """Make requests by calling the app as a WSGI callable"""
+    def request(method, path, data=None):
+        environ = EnvironBuilder(path=path, method=method, data=data,
+                                 content_type='application/json').get_environ()
+        status = []
+        body = app(environ, lambda s, h, e=None: status.append(s))
+        for _ in body:
+            pass
+        if hasattr(body, 'close'):
+            body.close()
+        return int(status[0].split(' ', 1)[0])
+    return request
+
+
+DRIVERS = dict(client=client_driver, wsgi=wsgi_driver)
+
+#
+# Scenarios
+#
+
+
+def scenarios(size, n):
+    """
+    The requests made for each verb, with those made afterwards, unmeasured,
+    to put the collection back to size items. Given a fresh app, POSTs add the
+    items after size, PUTs add the n after those and DELETE removes them.
+    """
+    body = json.dumps(dict(name=u'bench', value=1))
+    ids = [1 + (i * 7919) % size for i in xrange(n)]
+    posted = [size + i + 1 for i in xrange(n)]
+    new = [size + n + i + 1 for i in xrange(n)]
+    return [
+        ('GET', [('GET', '/item/%d' % i, None) for i in ids], []),
+        ('GET list', [('GET', '/item/?limit=100&after=%d' % i, None)
+                      for i in ids], []),
+        ('GET ids', [('GET', '/item/?ids=%s' % ','.join(
+            str(1 + (i + j) % size) for j in xrange(10)), None)
+            for i in ids], []),
+        ('OPTIONS', [('OPTIONS', '/item/', None)] * n, []),
+        ('POST', [('POST', '/item/', body)] * n,
+         [('DELETE', '/item/%d' % i, None) for i in posted]),
+        ('PUT', [('PUT', '/item/%d' % i, body) for i in new], []),
+        ('PATCH', [('PATCH', '/item/%d' % i, body) for i in ids], []),
+        ('DELETE', [('DELETE', '/item/%d' % i, None) for i in new], []),
+    ]
+
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def measure(request, calls):
+    """Time each call, giving requests/sec and latency percentiles in ms"""
+    latencies = []
+    errors = 0
+    start = time.time()
+    for method, path, data in calls:
+        t = time.time()
+        status = request(method, path, data)
+        latencies.append(time.time() - t)
+        if status >= 400:
+            errors += 1
+    elapsed = time.time() - start
+
+    latencies.sort()
+    return dict(requests=len(calls),
+                errors=errors,
+                rps=len(calls) / elapsed if elapsed else None,
+                p50_ms=percentile(latencies, .5) * 1000,
+                p99_ms=percentile(latencies, .99) * 1000)
+
+
+def measure_serialization(size, n=1000):
+    """
+    Time serializing rows with SqlAlchemyEndpoint and encoding them as Snooze
+    does, per object in microseconds
+    """
+    app, snooze, endpoint = sqlalchemy_snooze(min(size, n))
+    with app.test_request_context():
+        objs = endpoint.read_many(endpoint.read(None))
+
+        start = time.time()
+        data = [endpoint.serialize(o) for o in objs]
+        serialized = time.time()
+        snooze._hook_data_out(data)
+        encoded = time.time()
+
+    return dict(objects=len(objs),
+                serialize_us=(serialized - start) / len(objs) * 1e6,
+                encode_us=(encoded - serialized) / len(objs) * 1e6)
+
+
+def run(sizes, backends, drivers, n):
+    results = []
+    for size in sizes:
+        for backend in backends:
+            for driver in drivers:
+                # NB. a fresh app per driver, so that POSTs get the same ids
+                t = time.time()
+                app = BACKENDS[backend](size)
+                setup = time.time() - t
+                request = DRIVERS[driver](app)
+                for verb, calls, cleanup in scenarios(size, n):
+                    result = dict(size=size, backend=backend, driver=driver,
+                                  verb=verb, setup_s=setup)
+                    result.update(measure(request, calls))
+                    results.append(result)
+                    for method, path, data in cleanup:
+                        request(method, path, data)
+                    print >>sys.stderr, \
+                        '%(backend)s/%(driver)s size=%(size)d %(verb)s: ' \
+                        '%(rps).0f req/s, p50 %(p50_ms).3fms, ' \
+                        'p99 %(p99_ms).3fms' % result
+
+    return dict(meta=meta(),
+                results=results,
+                serialization=[dict(size=size, **measure_serialization(size))
+                               for size in sizes])
+
+
+def meta():
+    try:
+        commit = subprocess.Popen(
+            ['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0]
+    except OSError:
+        commit = ''
+    return dict(commit=commit.strip() or None,
+                python=platform.python_version(),
+                platform=platform.platform(),
+                time=datetime.utcnow().isoformat())
+
+
+def compare(before, after):
+    """Print the change in requests/sec and p99 between two result files"""
+    def key(r):
+        return r['size'], r['backend'], r['driver'], r['verb']
+    old = dict((key(r), r) for r in before['results'])
+    for r in after['results']:
+        o = old.get(key(r))
+        if o is None or not o['rps']:
+            continue
+        print '%-10s %-6s %-8s %-8s rps %+6.1f%%  p99 %+6.1f%%' % (
+            r['backend'], r['driver'], r['size'], r['verb'],
+            (r['rps'] / o['rps'] - 1) * 100,
+            (r['p99_ms'] / o['p99_ms'] - 1) * 100 if o['p99_ms'] else 0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='10,1000,100000',
+                        help='collection sizes, up to 1000000')
+    parser.add_argument('--backends', default='memory,sqlalchemy')
+    parser.add_argument('--drivers', default='client,wsgi')
+    parser.add_argument('-n', type=int, default=200,
+                        help='requests per verb')
+    parser.add_argument('-o', '--output', help='file to write results to')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        before, after = [json.load(open(f)) for f in args.compare]
+        compare(before, after)
+        return
+
+    results = run([int(s) for s in args.sizes.split(',')],
+                  args.backends.split(','), args.drivers.split(','), args.n)
+    out = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out)
+    else:
+        print out
+
+
+if __name__ == '__main__':
+    main()
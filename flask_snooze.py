@@ -17,7 +17,24 @@ e.g.
     app.register_blueprint(api, url_prefix='/api_v1')
 """
 
-from flask import request, make_response
+from flask import request, make_response, current_app, has_request_context
+from functools import partial
+from werkzeug.urls import url_encode
+from werkzeug.http import is_resource_modified, generate_etag
+from collections import OrderedDict, deque
+from decimal import Decimal
+from datetime import date, datetime, time as dt_time, timedelta
+from itertools import izip
+from operator import attrgetter
+from bisect import bisect_left
+from threading import Lock, Condition, Event
+from multiprocessing import TimeoutError
+from math import ceil
+import operator
+import zlib
+import random
+import sys
+import time
 import re
 
 try:
@@ -26,261 +43,2868 @@ except ImportError:
     import json
 
 
-class NotFoundError(Exception):
+class SnoozeError(Exception):
+
+    """
+    An error to be reported to the client with an HTTP status.
+    """
+
+    status = '500'
+
+    headers = ()
+
+    # NB. errors whose message and detail are drawn from a fixed set have
+    #     their encoded payloads kept
+    static = False
+
+    def __init__(self, message, **detail):
+        super(SnoozeError, self).__init__()
+
+        self.message = message
+        self.detail = detail
+
+
+class NotFoundError(SnoozeError):
 
     """
     Resource not found.
     """
 
-    def __init__(self, cls, path):
-        super(NotFoundError, self).__init__()
+    status = '404'
+
+    def __init__(self, cls, path):
+        super(NotFoundError, self).__init__(
+            'No %(cls)s exists with an ID of %(path)s' % dict(
+                cls=cls.__name__,
+                path=path
+            ),
+            **{'class': cls.__name__, 'path': path}
+        )
+
+        self.cls = cls
+        self.path = path
+
+
+class PreconditionFailedError(SnoozeError):
+
+    """
+    Resource does not meet the conditions given with the request.
+    """
+
+    status = '412'
+
+    def __init__(self, cls, path):
+        super(PreconditionFailedError, self).__init__(
+            'The %(cls)s with an ID of %(path)s does not meet the request '
+            'preconditions' % dict(
+                cls=cls.__name__,
+                path=path
+            ),
+            **{'class': cls.__name__, 'path': path}
+        )
+
+        self.cls = cls
+        self.path = path
+
+
+class ServiceUnavailableError(SnoozeError):
+
+    """
+    The endpoint is too busy to take the request, it may be retried later.
+    """
+
+    status = '503'
+
+    static = True
+
+    def __init__(self, message, retry_after=1):
+        super(ServiceUnavailableError, self).__init__(message)
+
+        self.headers = [('Retry-After', str(retry_after))]
+
+
+class TooManyRequestsError(SnoozeError):
+
+    """
+    The client has used up its allowance of requests, it may retry later.
+    """
+
+    status = '429'
+
+    static = True
+
+    def __init__(self, message, retry_after=1):
+        super(TooManyRequestsError, self).__init__(message)
+
+        self.headers = [('Retry-After', str(max(1, int(ceil(retry_after)))))]
+
+
+class BadRequestError(SnoozeError):
+
+    """
+    The request cannot be understood, e.g. an unknown filter was given.
+    """
+
+    status = '400'
+
+
+class ValidationError(BadRequestError):
+
+    """
+    Data sent cannot be applied to an object, errors mapping each offending
+    key to what is wrong with it.
+    """
+
+    status = '422'
+
+    def __init__(self, errors):
+        super(ValidationError, self).__init__(
+            'Invalid data: %s' % ', '.join(
+                '%s (%s)' % (k, errors[k]) for k in sorted(errors)),
+            errors=errors)
+
+        self.errors = errors
+
+
+def error_dict(etype, message, **kwargs):
+    d = dict(type=etype, message=message)
+    if kwargs:
+        d['detail'] = kwargs
+    return d
+
+
+class CoerceToDictEncoder(json.JSONEncoder):
+
+    """
+    A fairly naive encoder that will try to convert unrecognised types to dict.
+    The idea being that objects can be made iterable quite easily as a bridge
+    to being converted to JSON.
+    """
+
+    def default(self, obj):
+        if obj is None or type(obj) in (
+                dict,
+                list, tuple,
+                str, unicode,
+                int, long, float,
+                bool):
+            return json.JSONEncoder.default(self, obj)
+
+        return dict(obj)
+
+
+#
+# Codecs
+#
+
+
+def encode_default(obj):
+    """
+    Coerce a value JSON has no type for: dates and times to ISO 8601 strings,
+    Decimals to floats and anything else, such as a row or an iterable model,
+    to a dict.
+    """
+    if isinstance(obj, (datetime, date, dt_time)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    return dict(obj)
+
+
+def select_json_backend(names=('orjson', 'msgspec', 'ujson', 'simplejson',
+                               'json')):
+    """
+    Pick the first of the named JSON libraries that can be imported, giving its
+    name, a loads function and a function constructing an encoder (taking a
+    default hook) that gives byte strings.
+    """
+    for name in names:
+        try:
+            module = __import__(name)
+        except ImportError:
+            continue
+
+        if name == 'orjson':
+            return name, module.loads, \
+                lambda default: partial(module.dumps, default=default)
+        if name == 'msgspec':
+            from msgspec import json as mjson
+            return name, mjson.decode, \
+                lambda default: mjson.Encoder(enc_hook=default).encode
+        if name == 'ujson':
+            try:
+                module.dumps(object(), default=repr)
+            except TypeError:
+                continue  # NB. older versions take no default hook
+
+            def ujson_encoder(default):
+                return lambda obj: module.dumps(
+                    obj, default=default, ensure_ascii=True)
+            return name, module.loads, ujson_encoder
+
+        return name, module.loads, lambda default: module.JSONEncoder(
+            default=default, separators=(',', ':')).encode
+
+    raise ImportError('No JSON library found')
+
+
+JSON_BACKEND = select_json_backend()
+
+
+class JSONCodec(object):
+
+    """
+    Decode and encode JSON with the fastest library available, see
+    select_json_backend. Encoded bodies are ASCII byte strings.
+    """
+
+    mimetype = 'application/json'
+
+    # NB. how to write a list out an item at a time: start, separator, end
+    array = '[', ',', ']'
+
+    def __init__(self, default=encode_default, backend=None):
+        """
+        default:        Coerces values the library cannot encode
+        backend:        A (name, loads, encoder) tuple, defaults to the one
+                        picked at import
+        """
+        self.name, self.decode, encoder = \
+            JSON_BACKEND if backend is None else backend
+        self.encode = encoder(default)
+
+
+class MsgPackCodec(object):
+
+    """
+    Decode and encode MessagePack, needing the msgpack library. Lists cannot be
+    written out an item at a time, so streamed lists are written in another
+    codec, see Negotiator.codec_stream.
+    """
+
+    mimetype = 'application/msgpack'
+    mimetypes = ('application/msgpack', 'application/x-msgpack')
+    array = None
+
+    def __init__(self, default=encode_default):
+        import msgpack
+        self.decode = partial(msgpack.unpackb, raw=False)
+        self.encode = partial(msgpack.packb, default=default,
+                              use_bin_type=False)
+
+
+class CBORCodec(object):
+
+    """
+    Decode and encode CBOR, needing the cbor2 library. Naive datetimes are
+    taken to be UTC.
+    """
+
+    mimetype = 'application/cbor'
+    array = '\x9f', '', '\xff'
+
+    def __init__(self, default=encode_default):
+        import cbor2
+        try:
+            from datetime import timezone
+        except ImportError:
+            from cbor2.compat import timezone
+
+        self.decode = cbor2.loads
+        self.encode = partial(cbor2.dumps,
+                              timezone=timezone.utc,
+                              default=lambda e, v: e.encode(default(v)))
+
+
+def default_codecs():
+    """A JSONCodec, followed by those binary codecs whose library is present"""
+    codecs = [JSONCodec()]
+    for cls in MsgPackCodec, CBORCodec:
+        try:
+            codecs.append(cls())
+        except ImportError:
+            pass
+    return codecs
+
+
+class Negotiator(object):
+
+    """
+    Pick a codec for each request: to decode the body by its Content-Type and
+    to encode the response by the Accept header, the first codec being the
+    default for both. Streamed lists are written with the best codec that can
+    write a list out an item at a time, JSON if none of them can.
+    """
+
+    def __init__(self, codecs):
+        self.codecs = list(codecs)
+        self.default = self.codecs[0]
+        self._offered = []
+        self._by_mimetype = {}
+        self._streamed_offered = []
+        self._streamed_by_mimetype = {}
+        for codec in self.codecs:
+            for m in getattr(codec, 'mimetypes', (codec.mimetype,)):
+                self._offered.append(m)
+                self._by_mimetype.setdefault(m, codec)
+                if codec.array is not None:
+                    self._streamed_offered.append(m)
+                    self._streamed_by_mimetype.setdefault(m, codec)
+        self._streamed_default = next(
+            (c for c in self.codecs if c.array is not None), None) or \
+            JSONCodec()
+
+    def codec_in(self):
+        """The codec for the body of the current request"""
+        return self._by_mimetype.get(request.mimetype, self.default)
+
+    def codec_out(self):
+        """The codec for the response to the current request"""
+        codec = request.environ.get('snooze.codec')
+        if codec is None:
+            m = request.accept_mimetypes.best_match(self._offered)
+            codec = request.environ['snooze.codec'] = \
+                self._by_mimetype.get(m, self.default)
+        return codec
+
+    def codec_stream(self):
+        """The codec for a list streamed to the current request"""
+        codec = self.codec_out()
+        if codec.array is not None:
+            return codec
+        m = request.accept_mimetypes.best_match(self._streamed_offered)
+        return self._streamed_by_mimetype.get(m, self._streamed_default)
+
+    def decode(self, data):
+        return self.codec_in().decode(data)
+
+    def encode(self, obj):
+        return self.codec_out().encode(obj)
+
+
+#
+# Compression
+#
+
+
+def gzip_compressor(level):
+    z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return z.compress, lambda: z.flush(zlib.Z_SYNC_FLUSH), z.flush
+
+
+def brotli_compressor(level):
+    import brotli
+    c = brotli.Compressor(quality=level)
+    return c.process, c.flush, c.finish
+
+
+def zstd_compressor(level):
+    import zstandard
+    z = zstandard.ZstdCompressor(level=level).compressobj()
+    return z.compress, \
+        lambda: z.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK), z.flush
+
+
+# content codings, in order of preference, each giving a function that takes a
+# level and gives (compress, flush, finish) functions for one body
+COMPRESSORS = OrderedDict((
+    ('br', brotli_compressor),
+    ('zstd', zstd_compressor),
+    ('gzip', gzip_compressor),
+))
+
+
+class Compression(object):
+
+    """
+    Compress responses with the best content coding the client accepts, of
+    gzip and, when their libraries are present, brotli and zstd. Bodies
+    smaller than min_size are left alone, streamed bodies are compressed
+    (and flushed) a chunk at a time.
+    """
+
+    def __init__(self, min_size=1024, levels=None, encodings=None):
+        """
+        min_size:       Smallest body to compress, in bytes
+        levels:         Compression level by coding, defaults to br 4, zstd 3
+                        and gzip 6
+        encodings:      Codings to offer, defaults to all that are available
+        """
+        self.min_size = min_size
+        self.levels = dict(br=4, zstd=3, gzip=6)
+        self.levels.update(levels or {})
+        self.encodings = []
+        for encoding in COMPRESSORS if encodings is None else encodings:
+            try:
+                COMPRESSORS[encoding](self.levels[encoding])
+            except ImportError:
+                continue
+            self.encodings.append(encoding)
+
+    def choose(self):
+        """The coding to use for the current request, or None"""
+        accept = request.accept_encodings
+        return accept.best_match([e for e in self.encodings if accept[e] > 0])
+
+    def compress(self, data, encoding):
+        compress, flush, finish = \
+            COMPRESSORS[encoding](self.levels[encoding])
+        return compress(data) + finish()
+
+    def iter_compressed(self, chunks, encoding):
+        compress, flush, finish = \
+            COMPRESSORS[encoding](self.levels[encoding])
+        for chunk in chunks:
+            out = compress(chunk) + flush()
+            if out:
+                yield out
+        yield finish()
+
+    def apply(self, res, encoding):
+        """Compress a successful response with a coding given by choose"""
+        if not 200 <= res.status_code < 300 or res.status_code == 204 or \
+                'Content-Encoding' in res.headers:
+            return res
+
+        res.vary.add('Accept-Encoding')
+        if encoding is None:
+            return res
+
+        if res.is_streamed:
+            res.response = self.iter_compressed(res.response, encoding)
+        else:
+            data = res.data
+            if len(data) < self.min_size:
+                return res
+            res.data = self.compress(data, encoding)
+        res.headers['Content-Encoding'] = encoding
+        return res
+
+
+def response_negotiated(res, codec):
+    """Make a response of res, typed as encoded by codec unless typed already"""
+    res = current_app.make_response(res)
+    if res.mimetype == res.default_mimetype:
+        res.mimetype = codec.mimetype
+    res.vary.add('Accept')
+    return res
+
+
+def wrap_verb_call(call, endpoint, data_in, data_out,
+                   body_cache=None, cache_prefix=None, metrics=None, name=None,
+                   server_timing=False, negotiator=None, compression=None,
+                   traceback_rate=0.0):
+    """
+    Construct a callback that will wrap a given HTTP Verb call, passing a path.
+
+    If a body_cache is given, encoded single-object GET responses are kept
+    in it, one entry per variant, under a generation kept under cache_prefix
+    and the path; other verbs discard the generation.
+
+    If a Metrics sink is given, the time spent decoding the body, in the call,
+    encoding the result and in total is given to it, labelled with name.
+    With server_timing the same timings are given in a Server-Timing header.
+
+    If a Negotiator is given, responses are typed with the codec it picked,
+    which also tells apart cached variants.
+
+    If a Compression is given, responses are compressed as the client accepts
+    after their ETag is worked out, and are cached compressed.
+
+    Unexpected errors give a 500 with a fixed payload, and are logged; the
+    traceback is only extracted, logged and given in the payload in debug
+    mode or for a traceback_rate sample of errors.
+    """
+    payloads = {}
+
+    def encode_error(etype, message, detail, static):
+        if not static:
+            return data_out(error_dict(etype, message, **detail))
+
+        key = etype, message, \
+            None if negotiator is None else negotiator.codec_out().mimetype
+        body = payloads.get(key)
+        if body is None:
+            body = payloads[key] = data_out(error_dict(etype, message,
+                                                       **detail))
+        return body
+
+    def f(path=None):
+        if metrics is None and not server_timing:
+            return respond(path, None)
+
+        verb = request.method
+        if metrics is not None:
+            metrics.start(name, verb)
+        timings = {}
+        start = time.time()
+        status = 500
+        try:
+            res = respond(path, timings)
+            status = response_status(res)
+        finally:
+            timings['total'] = time.time() - start
+            if metrics is not None:
+                metrics.finish(name, verb, timings, status)
+
+        if server_timing:
+            res = current_app.make_response(res)
+            res.headers['Server-Timing'] = server_timing_header(timings)
+        return res
+
+    def respond(path, timings):
+        key = cached = encoding = None
+        if compression is not None:
+            encoding = compression.choose()
+        if body_cache is not None and path is not None:
+            key = u'%s/%s' % (cache_prefix, endpoint.parse_key(path))
+            variant = request.query_string if negotiator is None else (
+                request.query_string, negotiator.codec_out().mimetype)
+            if compression is not None:
+                variant = variant, encoding
+            if request.method in ('GET', 'HEAD'):
+                cached = variant_key(
+                    key, cache_generation(body_cache, key), variant)
+                res = response_cached(body_cache.get(cached))
+                if res is not None:
+                    if negotiator is not None:
+                        res = response_negotiated(res, negotiator.codec_out())
+                    return res
+
+        t = time.time() if timings is not None else None
+        try:
+            try:
+                if getattr(data_in, 'reads_stream', False):
+                    data = data_in(request.stream)
+                elif request.data != '':
+                    data = data_in(request.data)
+                else:
+                    data = dict()
+            except Exception:
+                raise BadRequestError('The request body could not be decoded')
+            if not isinstance(data, dict):
+                raise BadRequestError('Data must be a dict')
+            if t is not None:
+                t = mark_time(timings, 'decode', t)
+
+            res = call(endpoint, path, data)
+            if t is not None:
+                t = mark_time(timings, 'endpoint', t)
+            if getattr(res, 'encoded', False):
+                # NB. streamed and 304 bodies need no further encoding
+                if compression is not None:
+                    res = compression.apply(res, encoding)
+                return res
+            try:
+                # NB. error_data used because Flask stringifies stuff we put
+                #     into res.data, which isn't good for us
+                res.data = data_out(res.error_data)
+            except AttributeError:
+                try:
+                    res.data = data_out(res.data)
+                except AttributeError:
+                    res = data_out(res)
+            if t is not None:
+                t = mark_time(timings, 'encode', t)
+            if getattr(res, 'conditional', False):
+                res.add_etag()
+                if compression is not None:
+                    res = compression.apply(res, encoding)
+                if cached is not None:
+                    cache_response(body_cache, cached, res)
+                res.make_conditional(request)
+        except SnoozeError, e:
+            res = make_response()
+            res.status = e.status
+            for h, v in e.headers:
+                res.headers[h] = v
+            res.data = encode_error(type(e).__name__, e.message, e.detail,
+                                    e.static)
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            if current_app.debug or (traceback_rate and
+                                     random.random() < traceback_rate):
+                from traceback import extract_tb
+                current_app.logger.error(
+                    'Error in %s %s', request.method, request.path,
+                    exc_info=(exc_type, exc_value, exc_traceback))
+                res = data_out(error_dict(exc_type.__name__,
+                               exc_value.message,
+                               traceback=extract_tb(exc_traceback))), '500'
+            else:
+                current_app.logger.error('%s in %s %s: %s', exc_type.__name__,
+                                         request.method, request.path,
+                                         exc_value)
+                res = encode_error('InternalServerError',
+                                   'The request could not be completed',
+                                   {}, True), '500'
+            del exc_traceback
+
+        if key is not None and request.method not in ('GET', 'HEAD'):
+            body_cache.delete(key)
+
+        if negotiator is not None:
+            res = response_negotiated(res, negotiator.codec_out())
+        if compression is not None:
+            res = compression.apply(current_app.make_response(res), encoding)
+        return res
+    return f
+
+
+def mark_time(timings, phase, start):
+    """Record the time since start against a phase, returning the time now"""
+    now = time.time()
+    timings[phase] = now - start
+    return now
+
+
+def server_timing_header(timings):
+    """Format timings in seconds as a Server-Timing header"""
+    return ', '.join('%s;dur=%.3f' % (phase, timings[phase] * 1000)
+                     for phase in ('decode', 'endpoint', 'encode', 'total')
+                     if phase in timings)
+
+
+def response_status(res):
+    """
+    The HTTP status of the result of a verb call, which may be a response, a
+    (body, status) tuple or a body.
+    """
+    if isinstance(res, tuple):
+        return int(res[1])
+    return getattr(res, 'status_code', 200)
+
+
+def cache_generation(body_cache, key):
+    """
+    The generation a resource's cached variants are kept under, starting one
+    if there is none. Deleting the key leaves every variant of the old
+    generation unreachable, to be evicted like any other entry.
+    """
+    generation = body_cache.get(key)
+    if generation is None:
+        generation = '%x' % random.getrandbits(64)
+        body_cache.set(key, generation)
+    return generation
+
+
+def variant_key(key, generation, variant):
+    """
+    The cache key of one variant (query string and encoding) of a resource.
+    """
+    return u'%s/%s/%s' % (key, generation, generate_etag(repr(variant)))
+
+
+def cache_response(body_cache, key, r):
+    """
+    Keep the encoded body and validators of a response.
+    """
+    body_cache.set(key, (r.data, [
+        (h, r.headers[h])
+        for h in ('ETag', 'Last-Modified', 'Content-Encoding', 'Vary')
+        if h in r.headers
+    ]))
+
+
+def response_cached(cached):
+    """
+    Construct a response from a cached body for the current request, or None
+    if there is none.
+    """
+    try:
+        body, headers = cached
+    except TypeError:
+        return None
+
+    r = make_response(body)
+    for h, v in headers:
+        r.headers[h] = v
+    return r.make_conditional(request)
+
+
+def response_redirect(endpoint, o, code):
+    return response_location(getattr(o, endpoint.id_key), code)
+
+
+def response_location(key, code):
+    r = make_response()
+    r.headers['Location'] = '%(path)s%(id)s' % dict(
+        path=re.sub('[^/]*$', '', request.path),
+        id=key
+    )
+    r.status = str(code)
+    return r
+
+
+def response_link_next(data, keys, limit):
+    """
+    Construct a response for a page of keys, linking to the next page if the
+    current one is full.
+    """
+    r = make_response()
+    r.error_data = data
+    if limit and len(keys) == limit:
+        args = request.args.copy()
+        args['limit'] = limit
+        args['after'] = keys[-1]
+        r.headers['Link'] = '<%(url)s?%(query)s>; rel="next"' % dict(
+            url=request.base_url,
+            query=url_encode(args)
+        )
+    return r
+
+
+def response_stream(chunks, data_out, ndjson=False, codec=None):
+    """
+    Construct a response that writes a list out chunk by chunk, encoding each
+    item with data_out as it is generated; as NDJSON if asked, one item per
+    line. If a codec is given it is used in place of data_out, and must have
+    a way to write a list out an item at a time unless writing NDJSON.
+    """
+    start, sep, end = '[', ',', ']'
+    mimetype = None
+    if codec is not None:
+        data_out = codec.encode
+        if not ndjson:
+            mimetype = codec.mimetype
+            start, sep, end = codec.array
+
+    def generate():
+        yield start
+        first = True
+        for chunk in chunks:
+            if chunk:
+                yield ('' if first else sep) + \
+                    sep.join(data_out(item) for item in chunk)
+                first = False
+        yield end
+
+    def generate_ndjson():
+        for chunk in chunks:
+            if chunk:
+                yield ''.join(data_out(item) + '\n' for item in chunk)
+
+    if ndjson:
+        r = current_app.response_class(generate_ndjson(),
+                                       mimetype='application/x-ndjson')
+    else:
+        r = current_app.response_class(generate(), mimetype=mimetype)
+    r.encoded = True
+    return r
+
+
+def response_conditional(endpoint, o):
+    """
+    Construct a response for an object carrying its validators, answering
+    with a 304 straight away if the client's copy is current.
+    """
+    r = make_response()
+    tag = endpoint.etag(o)
+    if tag is not None:
+        r.set_etag(tag)
+    modified = endpoint.last_modified(o)
+    if modified is not None:
+        r.last_modified = modified
+
+    if (tag is not None or modified is not None) and \
+            not is_resource_modified(request.environ,
+                                     r.headers.get('ETag'),
+                                     last_modified=modified):
+        r.status_code = 304
+        r.encoded = True
+        return r
+
+    r.error_data = endpoint.serialize(o)
+    r.conditional = True
+    return r
+
+
+def response_partial(endpoint, path, fields):
+    """
+    Construct a response for some fields of an object, conditional on a hash
+    of the body.
+    """
+    try:
+        o = endpoint.read_partial([path], fields)[0]
+    except IndexError:
+        raise NotFoundError(endpoint.cls, path)
+
+    r = make_response()
+    r.error_data = o
+    r.conditional = True
+    return r
+
+
+def iter_key_chunks(endpoint, after, limit, chunk_size, filters=None):
+    """
+    Walk the keys of an endpoint a chunk at a time, so that no more than
+    chunk_size keys are held in memory at once.
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        n = chunk_size if remaining is None else min(chunk_size, remaining)
+        keys = endpoint.read_keys(after, n, filters)
+        yield keys
+        if len(keys) < n:
+            return
+        after = keys[-1]
+        if remaining is not None:
+            remaining -= len(keys)
+
+
+NDJSON_MIMETYPES = frozenset(('application/x-ndjson', 'application/ndjson'))
+
+
+def bulk_data_in(data_in, line_in=None):
+    """
+    Construct a data_in hook for bulk writes, reading either a list or one
+    item per line (NDJSON) from the request stream and wrapping them in a
+    dict as {items: [...], ndjson: bool}. NDJSON items are parsed lazily with
+    line_in (by default data_in), which must not need the request as they are
+    parsed while the response is written.
+    """
+    line_in = data_in if line_in is None else line_in
+
+    def f(stream):
+        if request.mimetype in NDJSON_MIMETYPES:
+            return dict(items=iter_ndjson(stream, line_in), ndjson=True)
+
+        data = stream.read()
+        return dict(items=data_in(data) if data.strip() else [], ndjson=False)
+    f.reads_stream = True
+    return f
+
+
+def iter_ndjson(stream, data_in):
+    """
+    Parse a stream a line at a time, giving a BadRequestError in place of any
+    line that cannot be parsed.
+    """
+    # NB. iterating some werkzeug streams never stops, so read lines directly
+    for line in iter(stream.readline, ''):
+        if not line.strip():
+            continue
+        try:
+            yield data_in(line)
+        except Exception, e:
+            yield BadRequestError('Invalid item: %s' % (
+                e.message or type(e).__name__))
+
+
+def wants_ndjson():
+    """Whether the client prefers NDJSON over JSON"""
+    accept = request.accept_mimetypes
+    return max(accept[m] for m in NDJSON_MIMETYPES) > \
+        accept['application/json']
+
+
+def iter_chunked(items, chunk_size):
+    """Group an iterable into lists of at most chunk_size items"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# query string arguments with a meaning of their own on collection GETs
+RESERVED_ARGS = frozenset(('ids', 'expand', 'limit', 'after', 'stream',
+                           'fields', 'sort'))
+
+FILTER_OPERATORS = {
+    'eq': operator.eq,
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+    # NB. in is handled separately, its value being a list
+    'in': None,
+}
+
+
+def parse_filters(args, filterable_keys, is_key=None):
+    """
+    Parse filters of the form key=value or key__op=value from query string
+    arguments into a list of (key, op, value) tuples. The value of the "in"
+    operator is a comma separated list. Arguments for which is_key is false
+    are not filters, e.g. a cache-busting "_", so are ignored.
+    """
+    filters = []
+    for arg, value in args.iteritems(multi=True):
+        if arg in RESERVED_ARGS:
+            continue
+        key, _, op = arg.partition('__')
+        if is_key is not None and not is_key(key):
+            continue
+        op = op or 'eq'
+        if key not in filterable_keys or op not in FILTER_OPERATORS:
+            raise BadRequestError('Cannot filter on %s, valid keys for '
+                                  'filtering: %s' % (
+                                      arg, ', '.join(filterable_keys)))
+        filters.append((key, op, value.split(',') if op == 'in' else value))
+    return filters
+
+
+def parse_flag(value):
+    """Parse a boolean query string value, which is true if 1, true or yes"""
+    return value is not None and value.lower() in ('1', 'true', 'yes')
+
+
+def parse_limit(limit):
+    """Parse a limit, which must be a positive integer if given"""
+    if limit is None:
+        return None
+    try:
+        limit = int(limit)
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        raise BadRequestError('The limit must be a positive integer')
+    return limit
+
+
+def parse_order(sort, sortable_keys):
+    """
+    Parse a comma separated list of keys to sort by, each prefixed with - for
+    descending order, into a list of (key, descending) tuples.
+    """
+    if not sort:
+        return []
+
+    order = []
+    for key in sort.split(','):
+        desc = key.startswith('-')
+        key = key.lstrip('-')
+        if key not in sortable_keys:
+            raise BadRequestError('Cannot sort by %s, valid keys for '
+                                  'sorting: %s' % (
+                                      key, ', '.join(sortable_keys)))
+        order.append((key, desc))
+    return order
+
+
+def filter_shape(filters):
+    """
+    The shape of a list of filters: their keys and operators, and the number
+    of values for "in", but not the values themselves.
+    """
+    return tuple((k, op, len(v) if op == 'in' else None) for k, op, v in filters)
+
+
+def filter_match(value, op, arg):
+    """
+    Check a value against a filter, coercing the filter argument to the type
+    of the value where possible.
+    """
+    def coerce(a):
+        try:
+            return type(value)(a)
+        except (TypeError, ValueError):
+            return a
+
+    if op == 'in':
+        return value in [coerce(a) for a in arg]
+    return FILTER_OPERATORS[op](value, coerce(arg))
+
+
+#
+# Schemas
+#
+
+
+def coerce_int(v):
+    if isinstance(v, bool) or not isinstance(v, (int, long)):
+        raise ValueError('must be an integer')
+    return v
+
+
+def coerce_float(v):
+    if isinstance(v, bool) or not isinstance(v, (int, long, float)):
+        raise ValueError('must be a number')
+    return float(v)
+
+
+def coerce_decimal(v):
+    if isinstance(v, bool) or not isinstance(v, (int, long, float, Decimal,
+                                                 basestring)):
+        raise ValueError('must be a number')
+    try:
+        return Decimal(str(v) if isinstance(v, float) else v)
+    except ArithmeticError:
+        raise ValueError('must be a number')
+
+
+def coerce_bool(v):
+    if not isinstance(v, bool):
+        raise ValueError('must be a boolean')
+    return v
+
+
+def coerce_string(v):
+    if not isinstance(v, basestring):
+        raise ValueError('must be a string')
+    return v
+
+
+ISO_DATETIME = re.compile(
+    r'^(\d{4})-(\d\d)-(\d\d)(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6}))?)?'
+    r'(Z|[+-]\d\d:?\d\d)?)?$')
+
+
+def parse_datetime(v):
+    """Parse an ISO 8601 datetime, giving UTC for any with an offset"""
+    m = ISO_DATETIME.match(v) if isinstance(v, basestring) else None
+    if m is None:
+        raise ValueError('must be an ISO 8601 datetime')
+    y, mo, d, h, mi, sec, frac, tz = m.groups()
+    try:
+        dt = datetime(int(y), int(mo), int(d), int(h or 0), int(mi or 0),
+                      int(sec or 0), int((frac or '0').ljust(6, '0')))
+    except ValueError:
+        raise ValueError('must be an ISO 8601 datetime')
+    if tz and tz != 'Z':
+        offset = int(tz[1:3]) * 60 + int(tz[-2:])
+        dt -= timedelta(minutes=offset if tz[0] == '+' else -offset)
+    return dt
+
+
+def parse_date(v):
+    try:
+        return parse_datetime(v).date()
+    except ValueError:
+        raise ValueError('must be an ISO 8601 date')
+
+
+def parse_time(v):
+    if not isinstance(v, basestring):
+        raise ValueError('must be an ISO 8601 time')
+    try:
+        return parse_datetime('1970-01-01T' + v).time()
+    except ValueError:
+        raise ValueError('must be an ISO 8601 time')
+
+
+# coercers for types a Field may be declared with
+COERCERS = {
+    int: coerce_int,
+    long: coerce_int,
+    float: coerce_float,
+    Decimal: coerce_decimal,
+    bool: coerce_bool,
+    str: coerce_string,
+    unicode: coerce_string,
+    basestring: coerce_string,
+    datetime: parse_datetime,
+    date: parse_date,
+    dt_time: parse_time,
+}
+
+
+class Field(object):
+
+    """
+    A writeable key of a schema.
+    """
+
+    def __init__(self, type=None, nullable=True, max_length=None,
+                 required=True):
+        """
+        type:           A type with a coercer in COERCERS, or a function
+                        coercing a value and raising a ValueError if it
+                        cannot; None takes any value
+        nullable:       Whether None is allowed
+        max_length:     The greatest length of a value
+        required:       Whether the key must be given when writing a whole
+                        object, rather than being left to a default
+        """
+        self.type = type
+        self.nullable = nullable
+        self.max_length = max_length
+        self.required = required
+
+    def compile(self):
+        """
+        Build a function coercing a value, or None if any value will do.
+        """
+        if self.type is None and self.nullable and self.max_length is None:
+            return None
+
+        coerce = COERCERS.get(self.type, self.type)
+        nullable = self.nullable
+        max_length = self.max_length
+
+        def check(v):
+            if v is None:
+                if nullable:
+                    return None
+                raise ValueError('may not be null')
+            if coerce is not None:
+                v = coerce(v)
+            if max_length is not None and len(v) > max_length:
+                raise ValueError('must be at most %d long' % max_length)
+            return v
+        return check
+
+
+class Schema(object):
+
+    """
+    The keys of an object that may be written to, compiled to check and
+    coerce data in one pass, reporting every error together.
+    """
+
+    def __init__(self, fields):
+        """
+        fields:         A dict of Fields by key
+        """
+        self.fields = fields
+        self._required = frozenset(k for k, f in fields.iteritems()
+                                   if f.required)
+        self._checks = dict((k, f.compile()) for k, f in fields.iteritems())
+
+    def validate(self, data, partial=False):
+        """
+        Check and coerce data, which must hold every required key unless
+        partial, raising a ValidationError for any problems.
+        """
+        errors = {}
+        out = {}
+        checks = self._checks
+        for k, v in data.iteritems():
+            try:
+                check = checks[k]
+            except KeyError:
+                errors[k] = 'not writeable'
+                continue
+            if check is None:
+                out[k] = v
+                continue
+            try:
+                out[k] = check(v)
+            except (ValueError, TypeError), e:
+                errors[k] = e.message or 'is invalid'
+
+        if not partial:
+            errors.update((k, 'missing')
+                          for k in self._required.difference(data))
+        if errors:
+            raise ValidationError(errors)
+        return out
+
+
+class Snooze(object):
+
+    """
+    The API context manager,
+    The api level means:
+        every verb takes in and gives out data in the same ways
+    """
+
+    def __init__(self, app, hooks=None, chunk_size=1000, body_cache=None,
+                 metrics=None, metrics_route='/_metrics', server_timing=False,
+                 profiler=None, codecs=None, compression=None,
+                 traceback_rate=0.0, rate_limit=None, max_expand=1000):
+        """
+        chunk_size:     Number of keys read at a time when streaming lists
+        body_cache:     A Cache for encoded GET responses, used by every
+                        endpoint added unless overriden in add()
+        metrics:        A Metrics sink for request timings, used by every
+                        endpoint added unless overriden in add()
+        metrics_route:  Where to serve the metrics as text, if the sink can
+                        render them
+        server_timing:  Whether to give request timings in a Server-Timing
+                        header
+        profiler:       A Profiler to run some requests under
+        codecs:         Codecs to pick between for each request by its
+                        Content-Type and Accept headers, the first being the
+                        default; without hooks, JSON and the binary codecs
+                        whose library is present
+        compression:    A Compression for responses, used by every endpoint
+                        added unless overriden in add()
+        traceback_rate: Fraction of unexpected errors to give tracebacks for
+                        outside of debug mode
+        rate_limit:     A RateLimiter for calls into endpoints, used by every
+                        endpoint added unless overriden in add()
+        max_expand:     Most objects given at once by an expanded list, which
+                        is paged by it when there is no smaller limit, or
+                        asked for by ids
+        """
+        self._app = app
+        self._chunk_size = chunk_size
+        self._body_cache = body_cache
+        self._metrics = metrics
+        self._server_timing = server_timing
+        self._profiler = profiler
+        self._compression = compression
+        self._traceback_rate = traceback_rate
+        self._rate_limit = rate_limit
+        self._max_expand = max_expand
+        if codecs is None and hooks is None:
+            codecs = default_codecs()
+        hooks = dict() if hooks is None else hooks
+        self._negotiator = None
+        if codecs is not None and len(codecs) > 1:
+            self._negotiator = Negotiator(codecs)
+            hooks.setdefault('data_in', self._negotiator.decode)
+            hooks.setdefault('data_out', self._negotiator.encode)
+        codec = JSONCodec() if not codecs else codecs[0]
+        self._hook_data_in = hooks.get('data_in', codec.decode)
+        self._hook_data_out = hooks.get('data_out', codec.encode)
+        self._routes = {}
+        self._cors = {}
+        self._frozen = None
+
+        if metrics_route is not None and hasattr(metrics, 'render'):
+            self._app.route(metrics_route,
+                            methods=('GET',),
+                            endpoint='GET:%s' % metrics_route)(
+                lambda: current_app.response_class(
+                    metrics.render(), mimetype=metrics.mimetype))
+
+    def add(self, endpoint, name=None, methods=(
+            'OPTIONS', 'POST', 'GET', 'PUT', 'PATCH', 'DELETE'),
+            body_cache=None, bulkhead=None, coalesce=False, metrics=None,
+            profiler=None, compression=None, cors=None, rate_limit=None):
+        """
+        Add an endpoint for a class, the name defaults to a lowercase version
+        of the class name but can be overriden.
+
+        Methods can be specified, note that HEAD is automatically generated by
+        Flask to execute the GET method without returning a body.
+
+        A body_cache can be given to keep encoded GET responses for this
+        endpoint, see wrap_verb_call.
+
+        A Bulkhead can be given to limit concurrent calls into this endpoint,
+        and a RateLimiter to limit their rate in place of that given to
+        Snooze; False turns off rate limiting.
+
+        If coalesce is set, concurrent identical reads are collapsed into one
+        call, see CoalescedEndpoint; it may be a SingleFlight to share.
+
+        A Metrics sink, a Profiler and a Compression can be given in place of
+        those given to Snooze.
+
+        A CORS can be given to let browsers on other origins use the endpoint;
+        OPTIONS is then served for preflight requests whatever the methods.
+        """
+        obj_name = endpoint.cls.__name__.lower() if name is None else name
+        methods = [m.upper() for m in methods]
+        body_cache = self._body_cache if body_cache is None else body_cache
+        metrics = self._metrics if metrics is None else metrics
+        profiler = self._profiler if profiler is None else profiler
+        compression = self._compression if compression is None \
+            else compression
+        rate_limit = self._rate_limit if rate_limit is None else rate_limit
+        if coalesce:
+            endpoint = CoalescedEndpoint(
+                endpoint, None if coalesce is True else coalesce)
+        endpoint.compile()
+        cache_prefix = u'%s:%s' % (
+            obj_name,
+            getattr(self._hook_data_out, '__name__', 'data_out'))
+
+        self._frozen = None
+        if 'OPTIONS' in methods or cors is not None:
+            self._register_options(obj_name, cors)
+
+        for verb in 'POST', 'GET', 'PUT', 'PATCH', 'DELETE':
+            if verb not in methods:
+                continue
+
+            call = getattr(self, '_%s' % verb.lower())
+            if bulkhead is not None:
+                call = bulkhead.wrap(call)
+            if rate_limit:
+                call = rate_limit.wrap(call, obj_name)
+
+            l = wrap_verb_call(call=call,
+                               endpoint=endpoint,
+                               data_in=self._hook_data_in,
+                               data_out=self._hook_data_out,
+                               body_cache=body_cache,
+                               cache_prefix=cache_prefix,
+                               metrics=metrics,
+                               name=obj_name,
+                               server_timing=self._server_timing,
+                               negotiator=self._negotiator,
+                               compression=compression,
+                               traceback_rate=self._traceback_rate)
+            if profiler is not None:
+                l = profiler.wrap(l)
+            if cors is not None:
+                l = cors.wrap(l)
+
+            self._register(obj_name=obj_name,
+                           verb=verb,
+                           func=l)
+
+        if 'POST' in methods:
+            invalidate = None
+            if body_cache is not None:
+                invalidate = lambda path: body_cache.delete(
+                    u'%s/%s' % (cache_prefix, path))
+
+            call = partial(self._bulk, methods=methods, invalidate=invalidate)
+            if bulkhead is not None:
+                call = bulkhead.wrap(call)
+            if rate_limit:
+                call = rate_limit.wrap(call, u'%s/_bulk' % obj_name)
+
+            l = wrap_verb_call(call=call,
+                               endpoint=endpoint,
+                               data_in=bulk_data_in(self._hook_data_in,
+                                                    self._ndjson_in()),
+                               data_out=self._hook_data_out,
+                               metrics=metrics,
+                               name=u'%s/_bulk' % obj_name,
+                               server_timing=self._server_timing,
+                               negotiator=self._negotiator,
+                               compression=compression,
+                               traceback_rate=self._traceback_rate)
+            if profiler is not None:
+                l = profiler.wrap(l)
+            if cors is not None:
+                l = cors.wrap(l)
+
+            self._register_bulk(obj_name=obj_name, func=l)
+
+    #
+    # Verbs
+    #
+
+    def _options(self, route):
+        """
+        HTTP Verb endpoint, served from responses worked out once all routes
+        are registered, outside of wrap_verb_call.
+        """
+        frozen = self._frozen if self._frozen is not None else self._freeze()
+        body, headers, cors = frozen[route]
+        r = current_app.response_class(body, headers=headers)
+        if cors is not None:
+            cors.apply(r)
+        return r
+
+    def _post(self, endpoint, path, data):
+        """HTTP Verb endpoint"""
+        o = endpoint.create(path)
+        if data is not None:
+            self._fill(endpoint, o, data)
+
+        return response_redirect(endpoint, o, 201)
+
+    def _get(self, endpoint, path, data):
+        """HTTP Verb endpoint"""
+        fields = request.args.get('fields')
+        fields = fields.split(',') if fields else None
+
+        if path is None:
+            def read_many(paths):
+                if fields is not None:
+                    return endpoint.read_partial(paths, fields)
+                return [endpoint.serialize(o) for o in \
+                    endpoint.read_many(paths)]
+
+            if 'ids' in request.args:
+                ids = request.args['ids'].split(',')
+                if len(ids) > self._max_expand:
+                    raise BadRequestError('At most %d ids may be read at once'
+                                          % self._max_expand)
+                return read_many(ids)
+
+            expand = parse_flag(request.args.get('expand'))
+            limit = parse_limit(request.args.get('limit'))
+            after = request.args.get('after')
+            stream = parse_flag(request.args.get('stream'))
+            filters = parse_filters(request.args, endpoint.filterable_keys,
+                                    endpoint.is_key)
+            order = parse_order(request.args.get('sort'),
+                                endpoint.sortable_keys)
+            if order and (after is not None or stream or wants_ndjson()):
+                raise BadRequestError('Cannot sort when using after or '
+                                      'stream, results are in key order')
+
+            ndjson = wants_ndjson()
+            if stream or ndjson:
+                if expand:
+                    chunks = ([endpoint.serialize(o, fields) for o in c] \
+                        for c in endpoint.iter_chunks(after,
+                                                      limit,
+                                                      filters,
+                                                      self._chunk_size))
+                else:
+                    chunks = iter_key_chunks(endpoint,
+                                             after,
+                                             limit,
+                                             self._chunk_size,
+                                             filters)
+                return response_stream(chunks, self._hook_data_out, ndjson,
+                                       self._stream_codec(ndjson))
+            if expand and (limit is None or limit > self._max_expand):
+                # NB. expanded lists are paged, rather than load every object
+                limit = self._max_expand
+            if limit is not None or after is not None or filters or order:
+                keys = endpoint.read_keys(after, limit, filters, order)
+                return response_link_next(
+                    read_many(keys) if expand else keys,
+                    keys,
+                    None if order else limit)
+
+            return endpoint.read(None)
+
+        if fields is not None:
+            return response_partial(endpoint, path, fields)
+
+        return response_conditional(endpoint, endpoint.read(path))
+
+    def _put(self, endpoint, path, data):
+        """HTTP Verb endpoint"""
+        data = self._check_fill(endpoint, data)
+
+        if request.if_match or request.if_unmodified_since:
+            try:
+                if self._update_matching(endpoint, path, data):
+                    return
+            except NotFoundError:
+                raise PreconditionFailedError(endpoint.cls, path)
+
+            # NB. conditions are checked against the object, so load it
+            try:
+                o = endpoint.read(path)
+            except NotFoundError:
+                if request.if_match:
+                    raise PreconditionFailedError(endpoint.cls, path)
+            else:
+                self._check_match(endpoint, path, o)
+                self._update(endpoint, o, data)
+                return
+
+        if endpoint.upsert(path, data):
+            return response_location(path, 201)
+
+    def _patch(self, endpoint, path, data):
+        """HTTP Verb endpoint"""
+        data = self._check_update(endpoint, data)
+
+        if request.if_match or request.if_unmodified_since:
+            if self._update_matching(endpoint, path, data):
+                return
+            o = endpoint.read(path)
+            self._check_match(endpoint, path, o)
+            self._update(endpoint, o, data)
+            return
+
+        endpoint.update(path, data)
+
+    def _delete(self, endpoint, path, data):
+        """HTTP Verb endpoint"""
+        if request.if_match or request.if_unmodified_since:
+            self._check_match(endpoint, path, endpoint.read(path))
+        endpoint.delete(path)
+
+    def _bulk(self, endpoint, path, data, methods=(), invalidate=None):
+        """
+        Bulk write endpoint, taking a list of items of the form
+        {method: "POST"|"PUT"|"PATCH"|"DELETE", id: ..., data: {...}} and
+        giving a status for each.
+        """
+        items = data['items']
+        if data['ndjson']:
+            # NB. applied a chunk at a time as the response is written, once
+            #     the status is sent, so failed chunks are reported per item
+            logger = current_app.logger
+            return response_stream(
+                (self._bulk_chunk(endpoint, chunk, methods, invalidate,
+                                  logger) \
+                    for chunk in iter_chunked(items, self._chunk_size)),
+                self._hook_data_out,
+                ndjson=True,
+                codec=self._stream_codec(True))
+        if not isinstance(items, list):
+            raise BadRequestError('Bulk data must be a list of items')
+
+        return self._bulk_chunk(endpoint, items, methods, invalidate)
+
+    #
+    # Tools
+    #
+
+    def _ndjson_in(self):
+        """
+        The hook to decode NDJSON lines with, which must not depend on the
+        request as they are decoded while the response is written.
+        """
+        if self._negotiator is None:
+            return None
+        return self._negotiator.default.decode
+
+    def _stream_codec(self, ndjson):
+        """
+        The codec to write a streamed response with, picked now as the request
+        is gone by the time it is written; NDJSON is always the default.
+        """
+        if self._negotiator is None:
+            return None
+        return self._negotiator.default if ndjson else \
+            self._negotiator.codec_stream()
+
+    def _bulk_chunk(self, endpoint, items, methods, invalidate, logger=None):
+        """
+        Apply a list of bulk items, giving a result for each; if a logger is
+        given, errors writing them are logged and each gets a 500.
+        """
+        results = [None] * len(items)
+        ops = []
+        positions = []
+        for i, item in enumerate(items):
+            try:
+                ops.append(self._bulk_op(endpoint, item, methods))
+                positions.append(i)
+            except BadRequestError, e:
+                results[i] = dict(status=int(e.status), error=error_dict(
+                    type(e).__name__, e.message, **e.detail))
+
+        if ops:
+            try:
+                written = endpoint.write_many(ops)
+            except Exception, e:
+                if logger is None:
+                    raise
+                logger.error('%s in bulk write: %s', type(e).__name__, e)
+                error = error_dict('InternalServerError',
+                                   'The request could not be completed')
+                for i, (method, path, data) in izip(positions, ops):
+                    results[i] = dict(status=500, id=path, error=error)
+                return results
+
+            for i, (status, key) in izip(positions, written):
+                results[i] = dict(status=status, id=key)
+                if invalidate is not None:
+                    invalidate(key)
+
+        return results
+
+    def _bulk_op(self, endpoint, item, methods):
+        """Validate an item of a bulk write as a (method, path, data) tuple"""
+        if isinstance(item, BadRequestError):
+            raise item
+        if not isinstance(item, dict):
+            raise BadRequestError('Each item must be a dict')
+
+        method = unicode(item.get('method', '')).upper()
+        if method not in ('POST', 'PUT', 'PATCH', 'DELETE') or \
+                method not in methods:
+            raise BadRequestError('Unsupported method: %s' % method)
+
+        path = item.get('id')
+        if path is None and method != 'POST':
+            raise BadRequestError('An id is required for %s' % method)
+        if path is not None and (isinstance(path, bool) or
+                                 not isinstance(path, (basestring, int, long))):
+            raise BadRequestError('An id must be a string or an integer')
+
+        data = item.get('data', dict())
+        if not isinstance(data, dict):
+            raise BadRequestError('Data must be a dict')
+
+        if method in ('POST', 'PUT'):
+            data = self._check_fill(endpoint, data)
+        elif method == 'PATCH':
+            data = self._check_update(endpoint, data)
+
+        return method, path, data
+
+    def _update_matching(self, endpoint, path, data):
+        """
+        Write data under an If-Match alone in one step where the endpoint can,
+        giving False if the object must be loaded and checked instead.
+        """
+        if request.if_unmodified_since or not request.if_match or \
+                request.if_match.star_tag:
+            return False
+
+        updated = endpoint.update_matching(path, data,
+                                           request.if_match.as_set())
+        if updated is None:
+            return False
+        if not updated:
+            raise PreconditionFailedError(endpoint.cls, path)
+        return True
+
+    def _check_match(self, endpoint, path, o):
+        """
+        Ensure an object meets any If-Match or If-Unmodified-Since condition
+        on the request.
+        """
+        if request.if_match:
+            tag = endpoint.etag(o)
+            if tag is None:
+                tag = generate_etag(self._hook_data_out(endpoint.serialize(o)))
+            if not request.if_match.contains(tag):
+                raise PreconditionFailedError(endpoint.cls, path)
+
+        if request.if_unmodified_since:
+            modified = endpoint.last_modified(o)
+            if modified is not None and \
+                    modified.replace(microsecond=0) > \
+                    request.if_unmodified_since:
+                raise PreconditionFailedError(endpoint.cls, path)
+
+    def _update(self, endpoint, o, data):
+        """Write checked data to an object"""
+        for k in data:
+            setattr(o, k, data[k])
+        endpoint.finalize(o)
+
+    def _fill(self, endpoint, o, data):
+        self._update(endpoint, o, self._check_fill(endpoint, data))
+
+    def _check_update(self, endpoint, data):
+        return endpoint.validate(data, partial=True)
+
+    def _check_fill(self, endpoint, data):
+        return endpoint.validate(data)
+
+    def _register(self, obj_name, verb, func):
+        func.provide_automatic_options = False
+
+        route = '/%s/<path:path>' % obj_name
+        self._app.route(route,
+                        methods=(verb,),
+                        endpoint="%s:%s" % (verb, route))(func)
+
+        self._reg_options(verb, route)
+
+        if verb in ('OPTIONS', 'GET', 'POST'):
+            route = '/%s/' % obj_name
+            self._app.route(route,
+                            methods=(verb,),
+                            endpoint="%s:%s" % (verb, route),
+                            defaults={'path': None})(func)
+
+            self._reg_options(verb, route)
+
+    def _register_options(self, obj_name, cors):
+        for route, defaults in (('/%s/<path:path>' % obj_name, None),
+                                ('/%s/' % obj_name, {'path': None})):
+            func = lambda path=None, route=route: self._options(route)
+            func.provide_automatic_options = False
+            self._app.route(route,
+                            methods=('OPTIONS',),
+                            endpoint="OPTIONS:%s" % route,
+                            defaults=defaults)(func)
+
+            self._reg_options('OPTIONS', route)
+            self._cors[route] = cors
+
+    def _freeze(self):
+        """
+        Encode the route table, and work out the headers of the OPTIONS
+        response for each route.
+        """
+        routes = dict((route, list(verbs))
+                      for route, verbs in self._routes.iteritems())
+        # NB. served to every client alike, so encoded with the default codec
+        #     rather than that picked for the request doing the freezing
+        if self._negotiator is None:
+            body = self._hook_data_out(routes)
+            mimetype = None
+        else:
+            body = self._negotiator.default.encode(routes)
+            mimetype = self._negotiator.default.mimetype
+
+        frozen = {}
+        for route, verbs in routes.iteritems():
+            headers = [('Allow', ', '.join(verbs))]
+            if mimetype is not None:
+                headers.append(('Content-Type', mimetype))
+            cors = self._cors.get(route)
+            if cors is not None:
+                headers.extend(cors.preflight_headers(verbs))
+            frozen[route] = body, headers, cors
+
+        self._frozen = frozen
+        return frozen
+
+    def _register_bulk(self, obj_name, func):
+        func.provide_automatic_options = False
+
+        route = '/%s/_bulk' % obj_name
+        self._app.route(route,
+                        methods=('POST',),
+                        endpoint="POST:%s" % route,
+                        defaults={'path': None})(func)
+
+        self._reg_options('POST', route)
+
+    def _reg_options(self, verb, route):
+        verbs = self._routes.get(route, [])
+        verbs.append(verb)
+        if verb == 'GET':
+            # Flask adds 'HEAD' for GET
+            verbs.append('HEAD')
+        self._routes[route] = verbs
+
+
+class Endpoint(object):
+
+    """
+    Base Endpoint object.
+    """
+
+    def __init__(self, cls, id_key, writeable_keys,
+                 filterable_keys=(), sortable_keys=()):
+        """
+        cls:             Class of object being represented by this endpoint
+        id_key:          Identifying key of an object
+        writeable_keys:  A list of keys that may be written to on an object
+        filterable_keys: A list of keys that lists may be filtered on
+        sortable_keys:   A list of keys that lists may be sorted by
+        """
+        self.cls = cls
+        self.id_key = id_key
+        self.writeable_keys = writeable_keys
+        self.filterable_keys = filterable_keys
+        self.sortable_keys = sortable_keys
+
+    def compile(self):
+        """Prepare any per-class state, called when added to a Snooze"""
+        self._schema = Schema(self.schema())
+
+    def schema(self):
+        """
+        The keys that may be written to as a dict of Fields, by default taking
+        any value for each of writeable_keys
+        """
+        return dict((k, Field()) for k in self.writeable_keys or ())
+
+    def validate(self, data, partial=False):
+        """
+        Check and coerce data to be written, which must hold every required
+        key unless partial, raising a ValidationError for any problems
+        """
+        schema = getattr(self, '_schema', None)
+        if schema is None:
+            schema = self._schema = Schema(self.schema())
+        return schema.validate(data, partial)
+
+    def parse_key(self, path):
+        """
+        The identifying key of the object at path, as the backend would
+        compare it, e.g. for caching; by default the path as it is
+        """
+        return path
+
+    def is_key(self, key):
+        """
+        Whether key is one of the objects' keys, telling filters apart from
+        other query string arguments
+        """
+        return key == self.id_key or \
+            key in (self.writeable_keys or ()) or \
+            key in (self.filterable_keys or ()) or \
+            key in (self.sortable_keys or ())
+
+    def create(self, path=None):
+        """Create a new object"""
+        raise NotImplementedError()
+
+    def read(self, path):
+        """Load an existing object"""
+        raise NotImplementedError()
+
+    def read_many(self, paths):
+        """Load several existing objects, skipping any that do not exist"""
+        objs = []
+        for path in paths:
+            try:
+                objs.append(self.read(path))
+            except NotFoundError:
+                pass
+        return objs
+
+    def read_partial(self, paths, fields):
+        """
+        Load several existing objects as dicts of just the given fields,
+        skipping any that do not exist
+        """
+        return [self.serialize(o, fields) for o in self.read_many(paths)]
+
+    def write_many(self, ops):
+        """
+        Apply a list of (method, path, data) writes, as validated by Snooze,
+        giving a (status, id) tuple for each. Backends should override this to
+        apply them together, e.g. in one transaction.
+        """
+        results = []
+        for method, path, data in ops:
+            try:
+                if method == 'DELETE':
+                    self.delete(path)
+                    results.append((200, path))
+                    continue
+
+                status = 201
+                if method == 'POST':
+                    o = self.create(path)
+                else:
+                    try:
+                        o = self.read(path)
+                        status = 200
+                    except NotFoundError:
+                        if method == 'PATCH':
+                            raise
+                        o = self.create(path)
+
+                for k in data:
+                    setattr(o, k, data[k])
+                self.finalize(o)
+                results.append((status, getattr(o, self.id_key)))
+            except NotFoundError:
+                results.append((404, path))
+        return results
+
+    def iter_chunks(self, after=None, limit=None, filters=None,
+                    chunk_size=1000):
+        """
+        Walk objects in key order, as read_keys, giving lists of at most
+        chunk_size of them at a time
+        """
+        for keys in iter_key_chunks(self, after, limit, chunk_size, filters):
+            yield self.read_many(keys)
+
+    def read_keys(self, after=None, limit=None, filters=None, order=None):
+        """
+        List object IDs in key order, starting after the ID `after` and giving
+        at most `limit` of them. Objects may be filtered by a list of
+        (key, op, value) and sorted by a list of (key, descending) first.
+        Backends should override this to avoid loading every object.
+        """
+        keys = sorted(self.read(None))
+        if after is not None and keys:
+            try:
+                after = type(keys[0])(after)
+            except (TypeError, ValueError):
+                pass
+            keys = [k for k in keys if k > after]
+
+        if filters or order:
+            objs = [o for o in self.read_many(keys) if all(
+                filter_match(getattr(o, k), op, v) \
+                    for k, op, v in filters or ())]
+            for key, desc in reversed(order or ()):
+                objs.sort(key=attrgetter(key), reverse=desc)
+            keys = [getattr(o, self.id_key) for o in objs]
+
+        return keys[:limit]
+
+    def serialize(self, obj, fields=None):
+        """
+        Convert an object into something data_out can encode, limited to the
+        given fields if possible
+        """
+        return obj
+
+    def etag(self, obj):
+        """
+        A cheap entity tag for an object, e.g. from a version column; if None
+        is given a hash of the encoded object is used instead
+        """
+        return None
+
+    def last_modified(self, obj):
+        """The datetime at which an object was last modified, if known"""
+        return None
+
+    def finalize(self, obj):
+        """Save an object (if required)"""
+        raise NotImplementedError()
+
+    def update(self, path, data):
+        """
+        Write some keys of an existing object, raising NotFoundError if there
+        is none. Backends may override this to avoid loading the object.
+        """
+        o = self.read(path)
+        for k in data:
+            setattr(o, k, data[k])
+        self.finalize(o)
+
+    def update_matching(self, path, data, etags):
+        """
+        Write some keys of an existing object only if its ETag is one of
+        etags, in one step so that no other write comes between; gives False
+        if it is not, raising NotFoundError if there is no object. Gives None
+        if the backend cannot, the object then being loaded and checked.
+        """
+        return None
+
+    def upsert(self, path, data):
+        """
+        Write all keys of an object, creating it if need be; gives True if it
+        was created. Backends may override this to avoid loading the object.
+        """
+        created = False
+        try:
+            o = self.read(path)
+        except NotFoundError:
+            o = self.create(path)
+            created = True
+
+        for k in data:
+            setattr(o, k, data[k])
+        self.finalize(o)
+        return created
+
+    def delete(self, path):
+        """Delete the data for the provided ID"""
+        raise NotImplementedError()
+
+
+#
+# Caching
+#
+
+
+class Cache(object):
+
+    """
+    Base cache backend, implement this to share cached objects between
+    processes.
+    """
+
+    def get(self, key):
+        """Fetch a value, or None if it is not cached"""
+        raise NotImplementedError()
+
+    def set(self, key, value):
+        """Store a value"""
+        raise NotImplementedError()
+
+    def delete(self, key):
+        """Discard a value, if it is cached"""
+        raise NotImplementedError()
+
+    def stats(self):
+        """Backend-specific counters"""
+        return dict()
+
+
+class LRUCache(Cache):
+
+    """
+    An in-process cache holding at most max_size values, each for at most ttl
+    seconds (or forever if ttl is None), evicting the least recently used.
+    """
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and expires < time.time():
+                self.evictions += 1
+                return None
+            self._entries[key] = expires, value
+            return value
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else time.time() + self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = expires, value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        return dict(size=len(self._entries), evictions=self.evictions)
+
+
+class CachedEndpoint(Endpoint):
+
+    """
+    Wrap an endpoint with a read-through object cache. Only reads for GET and
+    HEAD are served from the cache, objects are invalidated as they are
+    finalized or deleted.
+    """
+
+    def __init__(self, endpoint, cache=None, prefix=None):
+        """
+        endpoint:       The Endpoint to cache reads from
+        cache:          A Cache backend, defaults to an LRUCache
+        prefix:         Namespace for keys in a shared cache, defaults to the
+                        lowercase class name
+        """
+        super(CachedEndpoint, self).__init__(endpoint.cls,
+                                             endpoint.id_key,
+                                             endpoint.writeable_keys,
+                                             endpoint.filterable_keys,
+                                             endpoint.sortable_keys)
+        self.endpoint = endpoint
+        self.cache = LRUCache() if cache is None else cache
+        self.prefix = endpoint.cls.__name__.lower() if prefix is None \
+            else prefix
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.endpoint, name)
+
+    def stats(self):
+        """Hit/miss counters, along with those of the cache backend"""
+        stats = self.cache.stats()
+        with self._lock:
+            stats.update(hits=self.hits, misses=self.misses)
+        return stats
+
+    def _count(self, hits, misses):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def _key(self, path):
+        # NB. keyed on the parsed key, so that e.g. 05 and 5 are one object
+        return u'%s/%s' % (self.prefix, self.endpoint.parse_key(path))
+
+    def _cacheable(self):
+        return request.method in ('GET', 'HEAD')
+
+    def compile(self):
+        self.endpoint.compile()
+
+    def schema(self):
+        return self.endpoint.schema()
+
+    def validate(self, data, partial=False):
+        return self.endpoint.validate(data, partial)
+
+    def is_key(self, key):
+        return self.endpoint.is_key(key)
+
+    def parse_key(self, path):
+        return self.endpoint.parse_key(path)
+
+    def create(self, path=None):
+        return self.endpoint.create(path)
+
+    def read(self, path):
+        if path is None or not self._cacheable():
+            return self.endpoint.read(path)
+
+        key = self._key(path)
+        o = self.cache.get(key)
+        if o is not None:
+            self._count(1, 0)
+            return o
+
+        self._count(0, 1)
+        o = self.endpoint.read(path)
+        self.cache.set(key, o)
+        return o
+
+    def read_many(self, paths):
+        if not self._cacheable():
+            return self.endpoint.read_many(paths)
+
+        keys = [self._key(path) for path in paths]
+        found = {}
+        missing = []
+        for key, path in izip(keys, paths):
+            o = self.cache.get(key)
+            if o is None:
+                missing.append(path)
+            else:
+                found[key] = o
+        self._count(len(found), len(missing))
+
+        if missing:
+            for o in self.endpoint.read_many(missing):
+                key = self._key(getattr(o, self.id_key))
+                self.cache.set(key, o)
+                found[key] = o
+
+        return [found[k] for k in keys if k in found]
+
+    def read_partial(self, paths, fields):
+        return self.endpoint.read_partial(paths, fields)
+
+    def read_keys(self, after=None, limit=None, filters=None, order=None):
+        return self.endpoint.read_keys(after, limit, filters, order)
+
+    def iter_chunks(self, after=None, limit=None, filters=None,
+                    chunk_size=1000):
+        return self.endpoint.iter_chunks(after, limit, filters, chunk_size)
+
+    def serialize(self, obj, fields=None):
+        return self.endpoint.serialize(obj, fields)
+
+    def etag(self, obj):
+        return self.endpoint.etag(obj)
+
+    def last_modified(self, obj):
+        return self.endpoint.last_modified(obj)
+
+    def write_many(self, ops):
+        results = self.endpoint.write_many(ops)
+        for status, path in results:
+            self.cache.delete(self._key(path))
+        return results
+
+    def finalize(self, obj):
+        key = self._key(getattr(obj, self.id_key))
+        self.endpoint.finalize(obj)
+        self.cache.delete(key)
+
+    def update(self, path, data):
+        self.endpoint.update(path, data)
+        self.cache.delete(self._key(path))
+
+    def update_matching(self, path, data, etags):
+        updated = self.endpoint.update_matching(path, data, etags)
+        if updated:
+            self.cache.delete(self._key(path))
+        return updated
+
+    def upsert(self, path, data):
+        created = self.endpoint.upsert(path, data)
+        self.cache.delete(self._key(path))
+        return created
+
+    def delete(self, path):
+        self.endpoint.delete(path)
+        self.cache.delete(self._key(path))
+
+
+#
+# Metrics
+#
+
+
+class Metrics(object):
+
+    """
+    A sink for request timings, see wrap_verb_call. Timings are given in
+    seconds for the phases decode, endpoint, encode and total, though only
+    total is certain to be present.
+    """
+
+    def start(self, name, verb):
+        """A request has started"""
+        pass
+
+    def finish(self, name, verb, timings, status):
+        """A request has finished with an HTTP status"""
+        pass
+
+
+class PrometheusMetrics(Metrics):
+
+    """
+    Keep histograms of timings, error counts and requests in flight by
+    endpoint and verb, to be rendered in the Prometheus text format.
+    """
+
+    mimetype = 'text/plain; version=0.0.4'
+
+    def __init__(self, buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1,
+                                2.5, 5, 10), prefix='snooze'):
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+
+        self._lock = Lock()
+        self._histograms = OrderedDict()
+        self._errors = OrderedDict()
+        self._in_flight = OrderedDict()
+
+    def start(self, name, verb):
+        with self._lock:
+            key = name, verb
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+
+    def finish(self, name, verb, timings, status):
+        with self._lock:
+            self._in_flight[name, verb] -= 1
+            for phase, seconds in timings.iteritems():
+                key = name, verb, phase
+                h = self._histograms.get(key)
+                if h is None:
+                    h = self._histograms[key] = [
+                        [0] * (len(self.buckets) + 1), 0.0]
+                h[0][bisect_left(self.buckets, seconds)] += 1
+                h[1] += seconds
+            if status >= 400:
+                key = name, verb, status
+                self._errors[key] = self._errors.get(key, 0) + 1
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format"""
+        def labels(**kwargs):
+            return u','.join(u'%s="%s"' % (k, v) for k, v in
+                             sorted(kwargs.iteritems()))
+
+        lines = []
+        with self._lock:
+            lines.append(u'# TYPE %s_seconds histogram' % self.prefix)
+            for (name, verb, phase), (counts, total) in \
+                    self._histograms.iteritems():
+                l = labels(endpoint=name, verb=verb, phase=phase)
+                n = 0
+                for le, count in izip(
+                        [repr(float(b)) for b in self.buckets] + ['+Inf'],
+                        counts):
+                    n += count
+                    lines.append(u'%s_seconds_bucket{%s,le="%s"} %d' % (
+                        self.prefix, l, le, n))
+                lines.append(u'%s_seconds_sum{%s} %r' % (
+                    self.prefix, l, total))
+                lines.append(u'%s_seconds_count{%s} %d' % (
+                    self.prefix, l, n))
+
+            lines.append(u'# TYPE %s_errors_total counter' % self.prefix)
+            for (name, verb, status), n in self._errors.iteritems():
+                lines.append(u'%s_errors_total{%s} %d' % (
+                    self.prefix, labels(endpoint=name, verb=verb,
+                                        status=status), n))
+
+            lines.append(u'# TYPE %s_in_flight gauge' % self.prefix)
+            for (name, verb), n in self._in_flight.iteritems():
+                lines.append(u'%s_in_flight{%s} %d' % (
+                    self.prefix, labels(endpoint=name, verb=verb), n))
+
+        return u'\n'.join(lines) + u'\n'
+
+
+class StatsdMetrics(Metrics):
+
+    """
+    Hand timings to a statsd style callback, taking a metric name, a value and
+    a type: 'ms' for timings in milliseconds, 'c' for counters and 'g' for
+    gauges.
+    """
+
+    def __init__(self, callback, prefix='snooze'):
+        self.callback = callback
+        self.prefix = prefix
 
-        self.cls = cls
-        self.path = path
-        self.message = 'No %(cls)s exists with an ID of %(path)s' % dict(
-            cls=cls.__name__,
-            path=path
-        )
+        self._lock = Lock()
+        self._in_flight = {}
 
+    def _name(self, name, verb, metric):
+        return '%s.%s.%s.%s' % (self.prefix, name.replace('/', '.'), verb,
+                                metric)
 
-def error_dict(etype, message, **kwargs):
-    d = dict(type=etype, message=message)
-    if kwargs:
-        d['detail'] = kwargs
-    return d
+    def _gauge(self, name, verb, delta):
+        with self._lock:
+            n = self._in_flight[name, verb] = \
+                self._in_flight.get((name, verb), 0) + delta
+        self.callback(self._name(name, verb, 'in_flight'), n, 'g')
 
+    def start(self, name, verb):
+        self._gauge(name, verb, 1)
 
-class CoerceToDictEncoder(json.JSONEncoder):
+    def finish(self, name, verb, timings, status):
+        self._gauge(name, verb, -1)
+        for phase, seconds in timings.iteritems():
+            self.callback(self._name(name, verb, phase), seconds * 1000, 'ms')
+        if status >= 400:
+            self.callback(self._name(name, verb, 'errors.%d' % status), 1,
+                          'c')
+
+
+#
+# Profiling
+#
+
+
+class Profiler(object):
 
     """
-    A fairly naive encoder that will try to convert unrecognised types to dict.
-    The idea being that objects can be made iterable quite easily as a bridge
-    to being converted to JSON.
+    Run a sample of requests, and those carrying a debug header with the
+    secret as its value, under cProfile. Reports are kept in reports, the
+    last keep of them, and handed to store if given; requests asking with the
+    debug header are answered with their report in place of the body.
     """
 
-    def default(self, obj):
-        if obj is None or type(obj) in (
-                dict,
-                list, tuple,
-                str, unicode,
-                int, long, float,
-                bool):
-            return json.JSONEncoder.default(self, obj)
+    def __init__(self, sample_rate=0.0, header='X-Snooze-Profile',
+                 secret=None, store=None, keep=10, sort='cumulative',
+                 limit=30):
+        """
+        sample_rate:    Fraction of requests to profile
+        header:         Request header asking for a profile
+        secret:         Value the header must have, if None it is ignored
+        store:          Callable taking the path and report of each profile
+        keep:           Number of reports to keep in reports
+        sort:           pstats sort order of reports
+        limit:          Number of functions listed in reports
+        """
+        self.sample_rate = sample_rate
+        self.header = header
+        self.secret = secret
+        self.store = store
+        self.sort = sort
+        self.limit = limit
+        self.reports = deque(maxlen=keep)
+
+    def _asked(self):
+        return self.secret is not None and \
+            request.headers.get(self.header) == self.secret
+
+    def wrap(self, f):
+        """Construct a version of a wrap_verb_call callback that profiles"""
+        def profiled(path=None):
+            asked = self._asked()
+            if not asked and (self.sample_rate <= 0 or
+                              random.random() >= self.sample_rate):
+                return f(path)
+
+            from cProfile import Profile
+            from pstats import Stats
+            from StringIO import StringIO
+
+            profile = Profile()
+            res = profile.runcall(f, path)
+
+            out = StringIO()
+            Stats(profile, stream=out).sort_stats(self.sort).print_stats(
+                self.limit)
+            report = out.getvalue()
+
+            self.reports.append((request.path, report))
+            if self.store is not None:
+                self.store(request.path, report)
+
+            if asked:
+                return current_app.response_class(report,
+                                                  mimetype='text/plain')
+            return res
+        return profiled
+
+
+#
+# CORS
+#
 
-        return dict(obj)
 
+class CORS(object):
 
-def wrap_verb_call(call, endpoint, data_in, data_out):
     """
-    Construct a callback that will wrap a given HTTP Verb call, passing a path.
+    Cross-origin resource sharing for an endpoint: preflight OPTIONS requests
+    are answered from headers worked out once, and other responses are marked
+    as readable by allowed origins.
     """
-    def f(path=None):
-        data = data_in(request.data) if request.data != '' else dict()
-        assert isinstance(data, dict), "Data must be a dict"
-        try:
-            res = call(endpoint, path, data)
-            try:
-                # NB. error_data used because Flask stringifies stuff we put
-                #     into res.data, which isn't good for us
-                res.data = data_out(res.error_data)
-            except AttributeError:
-                try:
-                    res.data = data_out(res.data)
-                except AttributeError:
-                    res = data_out(res)
-        except NotFoundError, e:
-            res = make_response()
-            res.status = '404'
-            res.data = data_out(error_dict(**{
-                'etype': type(e).__name__,
-                'message': e.message,
-                'class': e.cls.__name__,
-                'path': e.path
-            }))
-        except:
-            import sys
-            from traceback import extract_tb
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            res = data_out(error_dict(exc_type.__name__,
-                           exc_value.message,
-                           traceback=extract_tb(exc_traceback))), '500'
+
+    def __init__(self, origins='*', headers=(
+            'Content-Type', 'If-Match', 'If-None-Match', 'If-Modified-Since',
+            'If-Unmodified-Since'),
+            expose_headers=('ETag', 'Last-Modified', 'Link', 'Location'),
+            credentials=False, max_age=86400):
+        """
+        origins:        Origins allowed, or '*' for any
+        headers:        Request headers allowed
+        expose_headers: Response headers readable by scripts
+        credentials:    Whether cookies and authorization may be sent, only
+                        from a list of origins
+        max_age:        Seconds a preflight may be cached for
+        """
+        if credentials and origins == '*':
+            raise ValueError('Credentials need a list of origins, not *')
+        self.origins = origins if origins == '*' else frozenset(origins)
+        self.headers = headers
+        self.expose_headers = expose_headers
+        self.credentials = credentials
+        self.max_age = max_age
+
+    def allow_origin(self, origin):
+        """The Access-Control-Allow-Origin for an origin, or None"""
+        if origin is None:
+            return None
+        if self.origins == '*':
+            return '*'
+        return origin if origin in self.origins else None
+
+    def preflight_headers(self, verbs):
+        """The headers of a preflight response for a route"""
+        headers = [
+            ('Access-Control-Allow-Methods', ', '.join(verbs)),
+            ('Access-Control-Allow-Headers', ', '.join(self.headers)),
+            ('Access-Control-Max-Age', str(self.max_age)),
+        ]
+        if self.credentials:
+            headers.append(('Access-Control-Allow-Credentials', 'true'))
+        return headers
+
+    def apply(self, res):
+        """Mark a response as readable by the origin of the request"""
+        allowed = self.allow_origin(request.headers.get('Origin'))
+        if allowed is not None:
+            res.headers['Access-Control-Allow-Origin'] = allowed
+            if allowed != '*':
+                res.vary.add('Origin')
         return res
-    return f
 
+    def wrap(self, f):
+        """Construct a version of a wrap_verb_call callback marking responses"""
+        def marked(path=None):
+            res = f(path)
+            if 'Origin' not in request.headers:
+                return res
+            res = self.apply(current_app.make_response(res))
+            if self.expose_headers:
+                res.headers['Access-Control-Expose-Headers'] = \
+                    ', '.join(self.expose_headers)
+            if self.credentials:
+                res.headers['Access-Control-Allow-Credentials'] = 'true'
+            return res
+        return marked
 
-def response_redirect(endpoint, o, code):
-    r = make_response()
-    r.headers['Location'] = '%(path)s%(id)s' % dict(
-        path=re.sub('[^/]*$', '', request.path),
-        id=getattr(o, endpoint.id_key)
-    )
-    r.status = str(code)
-    return r
 
+#
+# Concurrency
+#
 
-class Snooze(object):
+
+class Bulkhead(object):
 
     """
-    The API context manager,
-    The api level means:
-        every verb takes in and gives out data in the same ways
+    Limit the number of concurrent calls into an endpoint, so that a slow
+    backend cannot tie up every worker. Calls beyond the limit queue for up to
+    queue_timeout seconds (forever if None) and are then refused with a 503.
+    Streamed responses, such as lists with stream=1 and NDJSON, hold their
+    place until the server closes them.
+
+    If pool_size is given calls are run on a bounded thread pool, in a copy of
+    the request context; with a call_timeout the worker gives up waiting for
+    a call after that many seconds and answers with a 503, the call still
+    holding its place until it completes.
     """
 
-    def __init__(self, app, hooks=None):
-        self._app = app
-        hooks = dict() if hooks is None else hooks
-        self._hook_data_in = hooks.get('data_in', json.loads)
-        self._hook_data_out = hooks.get('data_out', CoerceToDictEncoder().encode)
-        self._routes = {}
-
-    def add(self, endpoint, name=None, methods=(
-            'OPTIONS', 'POST', 'GET', 'PUT', 'PATCH', 'DELETE')):
+    def __init__(self, max_concurrent, queue_timeout=None, retry_after=1,
+                 pool_size=None, call_timeout=None):
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.pool_size = pool_size
+        self.call_timeout = call_timeout
+
+        self.active = 0
+        self.queued = 0
+        self.calls = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+
+        self._cond = Condition(Lock())
+        self._pool = None
+        self._pool_lock = Lock()
+
+    def stats(self):
+        """Current and cumulative counters, wait_time being in seconds"""
+        with self._cond:
+            return dict(active=self.active,
+                        queued=self.queued,
+                        calls=self.calls,
+                        rejected=self.rejected,
+                        timeouts=self.timeouts,
+                        wait_time=self.wait_time)
+
+    def acquire(self):
+        """Take a slot, waiting for one if need be"""
+        start = time.time()
+        with self._cond:
+            if self.active >= self.max_concurrent:
+                self.queued += 1
+                try:
+                    while self.active >= self.max_concurrent:
+                        remaining = None
+                        if self.queue_timeout is not None:
+                            remaining = start + self.queue_timeout - \
+                                time.time()
+                            if remaining <= 0:
+                                self.rejected += 1
+                                raise ServiceUnavailableError(
+                                    'Too many concurrent requests',
+                                    self.retry_after)
+                        self._cond.wait(remaining)
+                finally:
+                    self.queued -= 1
+
+            self.active += 1
+            self.calls += 1
+            self.wait_time += time.time() - start
+
+    def release(self):
+        """Give up a slot"""
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def wrap(self, call):
         """
-        Add an endpoint for a class, the name defaults to a lowercase version
-        of the class name but can be overriden.
-
-        Methods can be specified, note that HEAD is automatically generated by
-        Flask to execute the GET method without returning a body.
+        Construct a version of a verb call that goes through the bulkhead. A
+        streamed response keeps its slot until it is closed.
         """
-        obj_name = endpoint.cls.__name__.lower() if name is None else name
-        methods = [m.upper() for m in methods]
-
-        for verb in 'OPTIONS', 'POST', 'GET', 'PUT', 'PATCH', 'DELETE':
-            if verb not in methods:
-                continue
+        def f(endpoint, path, data):
+            self.acquire()
+            if self.pool_size is None:
+                try:
+                    res = call(endpoint, path, data)
+                except:
+                    self.release()
+                    raise
+                if not self._hold(res):
+                    self.release()
+                return res
+
+            app = current_app._get_current_object()
+            environ = request.environ
+            state = ['running']
+
+            def run():
+                try:
+                    with app.request_context(environ):
+                        res = call(endpoint, path, data)
+                except:
+                    self.release()
+                    raise
+                with self._cond:
+                    if state[0] == 'running' and self._hold(res):
+                        state[0] = 'held'
+                        return res
+                self.release()
+                return res
 
-            l = wrap_verb_call(call=getattr(self, '_%s' % verb.lower()),
-                               endpoint=endpoint,
-                               data_in=self._hook_data_in,
-                               data_out=self._hook_data_out)
+            try:
+                result = self._get_pool().apply_async(run)
+            except:
+                self.release()
+                raise
 
-            self._register(obj_name=obj_name,
-                           verb=verb,
-                           func=l)
+            try:
+                return result.get(self.call_timeout)
+            except TimeoutError:
+                with self._cond:
+                    self.timeouts += 1
+                    held = state[0] == 'held'
+                    state[0] = 'abandoned'
+                if held:
+                    self.release()
+                raise ServiceUnavailableError('Request timed out',
+                                              self.retry_after)
+        return f
+
+    def _hold(self, res):
+        """Whether a result is a streamed response, to release when closed"""
+        if not getattr(res, 'is_streamed', False):
+            return False
+        res.call_on_close(self.release)
+        return True
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                from multiprocessing.pool import ThreadPool
+                self._pool = ThreadPool(self.pool_size)
+            return self._pool
+
+
+class RateLimitStore(object):
 
-    #
-    # Verbs
-    #
+    """
+    Where a RateLimiter keeps its token buckets; subclass to share buckets
+    between processes, e.g. in Redis.
+    """
 
-    def _options(self, endpoint, path, data):
-        """HTTP Verb endpoint"""
-        return self._routes
+    def take(self, key, rate, burst, cost=1):
+        """
+        Take cost tokens from the bucket for key, refilled at rate tokens a
+        second up to burst, giving 0 if they were taken or else the seconds
+        until they could be.
+        """
+        raise NotImplementedError()
 
-    def _post(self, endpoint, path, data):
-        """HTTP Verb endpoint"""
-        o = endpoint.create(path)
-        if data is not None:
-            self._fill(endpoint, o, data)
 
-        return response_redirect(endpoint, o, 201)
+class MemoryRateLimitStore(RateLimitStore):
 
-    def _get(self, endpoint, path, data):
-        """HTTP Verb endpoint"""
-        return endpoint.read(path)
+    """
+    Keep token buckets in this process.
 
-    def _put(self, endpoint, path, data):
-        """HTTP Verb endpoint"""
-        created = False
-        try:
-            o = endpoint.read(path)
-        except NotFoundError:
-            o = endpoint.create(path)
-            created = True
+    A bucket is kept as the time at which it will be full again, so is
+    dropped once that has passed. Keys are spread over stripes each with
+    their own lock, so that threads rarely wait on each other; a stripe is
+    swept of full buckets at most once a second when holding more than
+    max_keys / stripes of them.
+    """
 
-        self._fill(endpoint, o, data)
+    def __init__(self, stripes=16, max_keys=100000):
+        self._locks = [Lock() for _ in xrange(stripes)]
+        self._buckets = [dict() for _ in xrange(stripes)]
+        self._swept = [0.0] * stripes
+        self._stripe_keys = max(1, max_keys // stripes)
 
-        if created:
-            return response_redirect(endpoint, o, 201)
+    def __len__(self):
+        return sum(len(b) for b in self._buckets)
 
-    def _patch(self, endpoint, path, data):
-        """HTTP Verb endpoint"""
-        o = endpoint.read(path)
-        self._update(endpoint, o, data)
+    def take(self, key, rate, burst, cost=1):
+        i = hash(key) % len(self._locks)
+        buckets = self._buckets[i]
+        now = time.time()
+        with self._locks[i]:
+            full = buckets.get(key, now)
+            if full < now:
+                full = now
+            full += cost / rate
+            wait = full - burst / rate - now
+            if wait > 0:
+                return wait
+            buckets[key] = full
 
-    def _delete(self, endpoint, path, data):
-        """HTTP Verb endpoint"""
-        endpoint.delete(path)
+            if len(buckets) > self._stripe_keys and \
+                    now - self._swept[i] >= 1:
+                self._swept[i] = now
+                for k in [k for k, t in buckets.iteritems() if t <= now]:
+                    del buckets[k]
+        return 0
 
-    #
-    # Tools
-    #
 
-    def _update(self, endpoint, o, data):
-        for k in data:
-            assert k in endpoint.writeable_keys, \
-                "Cannot update key %s, valid keys for update: %s" % \
-                    (k, ', '.join(endpoint.writeable_keys))
-            setattr(o, k, data[k])
-        endpoint.finalize(o)
+def client_address():
+    """The default client key for a RateLimiter, the remote address"""
+    return request.remote_addr or ''
 
-    def _fill(self, endpoint, o, data):
-        items_set = set(endpoint.writeable_keys)
-        keys_set = set(data.keys())
-        assert items_set == keys_set, \
-            "The provided keys (%s) do not match the expected items (%s)" % \
-                (', '.join(keys_set), ', '.join(items_set))
 
-        self._update(endpoint, o, data)
+class RateLimiter(object):
 
-    def _register(self, obj_name, verb, func):
-        func.provide_automatic_options = False
+    """
+    Limit the rate of calls into endpoints with token buckets, refused calls
+    being answered with a 429 and a Retry-After header.
 
-        route = '/%s/<path:path>' % obj_name
-        self._app.route(route,
-                        methods=(verb,),
-                        endpoint="%s:%s" % (verb, route))(func)
+    Buckets are kept per the parts of each call given in by: 'client', taken
+    from the client function, 'verb' and 'endpoint'. Responses served from a
+    body_cache never reach the endpoint, so are not counted.
+    """
 
-        self._reg_options(verb, route)
+    def __init__(self, rate, burst=None, by=('client',), client=None,
+                 store=None):
+        """
+        rate:           Calls allowed a second, on average
+        burst:          Calls allowed at once, by default rate (at least 1)
+        by:             The parts of a call that buckets are kept by
+        client:         A function giving the key of the client making a
+                        request, by default its remote address; behind a
+                        proxy or with API keys give your own
+        store:          A RateLimitStore, by default one in memory
+        """
+        for part in by:
+            if part not in ('client', 'verb', 'endpoint'):
+                raise ValueError('Cannot rate limit by %r' % part)
+        self.rate = float(rate)
+        self.burst = float(max(1, rate) if burst is None else burst)
+        self.by = tuple(by)
+        self.client = client_address if client is None else client
+        self.store = MemoryRateLimitStore() if store is None else store
+
+        self.limited = 0
+        self._lock = Lock()
+
+    def stats(self):
+        """The number of calls refused"""
+        with self._lock:
+            return dict(limited=self.limited)
+
+    def check(self, name):
+        """Take a token for a call into the endpoint called name"""
+        key = []
+        for part in self.by:
+            if part == 'client':
+                key.append(self.client())
+            elif part == 'verb':
+                # NB. HEAD is a GET without a body
+                key.append('GET' if request.method == 'HEAD'
+                           else request.method)
+            else:
+                key.append(name)
+
+        wait = self.store.take(tuple(key), self.rate, self.burst)
+        if wait:
+            with self._lock:
+                self.limited += 1
+            raise TooManyRequestsError('Rate limit exceeded', wait)
+
+    def wrap(self, call, name):
+        """Construct a version of a verb call that is rate limited"""
+        def f(endpoint, path, data):
+            self.check(name)
+            return call(endpoint, path, data)
+        return f
+
+
+class SingleFlight(object):
 
-        if verb in ('OPTIONS', 'GET', 'POST'):
-            route = '/%s/' % obj_name
-            self._app.route(route,
-                            methods=(verb,),
-                            endpoint="%s:%s" % (verb, route),
-                            defaults={'path': None})(func)
+    """
+    Collapse concurrent calls sharing a key into a single call, the result
+    (or exception) of which is handed to every caller.
+    """
 
-            self._reg_options(verb, route)
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+
+        self._lock = Lock()
+        self._flights = {}
+
+    def stats(self):
+        """Calls made, calls answered by another's call, and calls in flight"""
+        with self._lock:
+            return dict(calls=self.calls,
+                        shared=self.shared,
+                        in_flight=len(self._flights))
+
+    def do(self, key, fn, *args):
+        """Call fn with args, unless a call for key is already in flight"""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Event()
+                flight.result = flight.error = None
+            else:
+                self.shared += 1
+
+        if not leader:
+            flight.wait()
+            if flight.error is not None:
+                raise flight.error[0], flight.error[1], flight.error[2]
+            return flight.result
 
-    def _reg_options(self, verb, route):
-        verbs = self._routes.get(route, [])
-        verbs.append(verb)
-        if verb == 'GET':
-            # Flask adds 'HEAD' for GET
-            verbs.append('HEAD')
-        self._routes[route] = verbs
+        try:
+            flight.result = fn(*args)
+            return flight.result
+        except:
+            flight.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                self.calls += 1
+            flight.set()
 
 
-class Endpoint(object):
+class CoalescedEndpoint(Endpoint):
 
     """
-    Base Endpoint object.
+    Wrap an endpoint so that concurrent identical reads for GET and HEAD are
+    made once, keyed by the read and its arguments (path, fields, filters and
+    so on). Objects are shared between the requests waiting on a read, so
+    should not be changed by them.
     """
 
-    def __init__(self, cls, id_key, writeable_keys):
+    def __init__(self, endpoint, flight=None, prefix=None):
         """
-        cls:            Class of object being represented by this endpoint
-        id_key:         Identifying key of an object
-        writeable_keys: A list of keys that may be written to on an object
+        endpoint:       The Endpoint to coalesce reads for
+        flight:         A SingleFlight, defaults to a new one
+        prefix:         Namespace for keys in a shared SingleFlight, defaults
+                        to the lowercase class name
         """
-        self.cls = cls
-        self.id_key = id_key
-        self.writeable_keys = writeable_keys
+        super(CoalescedEndpoint, self).__init__(endpoint.cls,
+                                                endpoint.id_key,
+                                                endpoint.writeable_keys,
+                                                endpoint.filterable_keys,
+                                                endpoint.sortable_keys)
+        self.endpoint = endpoint
+        self.flight = SingleFlight() if flight is None else flight
+        self.prefix = endpoint.cls.__name__.lower() if prefix is None \
+            else prefix
+
+    def __getattr__(self, name):
+        return getattr(self.endpoint, name)
+
+    def stats(self):
+        return self.flight.stats()
+
+    def _do(self, name, *args):
+        fn = getattr(self.endpoint, name)
+        # NB. streamed responses read once the request is gone, uncoalesced
+        if not has_request_context() or \
+                request.method not in ('GET', 'HEAD'):
+            return fn(*args)
+        return self.flight.do((self.prefix, name, repr(args)), fn, *args)
+
+    def compile(self):
+        self.endpoint.compile()
+
+    def schema(self):
+        return self.endpoint.schema()
+
+    def validate(self, data, partial=False):
+        return self.endpoint.validate(data, partial)
+
+    def is_key(self, key):
+        return self.endpoint.is_key(key)
+
+    def parse_key(self, path):
+        return self.endpoint.parse_key(path)
 
     def create(self, path=None):
-        """Create a new object"""
-        raise NotImplementedError()
+        return self.endpoint.create(path)
 
     def read(self, path):
-        """Load an existing object"""
-        raise NotImplementedError()
+        return self._do('read', path)
+
+    def read_many(self, paths):
+        return self._do('read_many', paths)
+
+    def read_partial(self, paths, fields):
+        return self._do('read_partial', paths, fields)
+
+    def read_keys(self, after=None, limit=None, filters=None, order=None):
+        return self._do('read_keys', after, limit, filters, order)
+
+    def iter_chunks(self, after=None, limit=None, filters=None,
+                    chunk_size=1000):
+        return self.endpoint.iter_chunks(after, limit, filters, chunk_size)
+
+    def serialize(self, obj, fields=None):
+        return self.endpoint.serialize(obj, fields)
+
+    def etag(self, obj):
+        return self.endpoint.etag(obj)
+
+    def last_modified(self, obj):
+        return self.endpoint.last_modified(obj)
+
+    def write_many(self, ops):
+        return self.endpoint.write_many(ops)
 
     def finalize(self, obj):
-        """Save an object (if required)"""
-        raise NotImplementedError()
+        self.endpoint.finalize(obj)
+
+    def update(self, path, data):
+        self.endpoint.update(path, data)
+
+    def update_matching(self, path, data, etags):
+        return self.endpoint.update_matching(path, data, etags)
+
+    def upsert(self, path, data):
+        return self.endpoint.upsert(path, data)
 
     def delete(self, path):
-        """Delete the data for the provided ID"""
-        raise NotImplementedError()
+        self.endpoint.delete(path)
 
 
 #
@@ -301,17 +2925,232 @@ def row2dict(row):
     return d
 
 
+def column_converter(column):
+    """
+    A function converting values of a column into something encodable, or
+    None if they need no conversion.
+    """
+    from sqlalchemy import types
+    if isinstance(column.type, (types.Date, types.DateTime, types.Time)):
+        return lambda v: v.isoformat()
+    return None
+
+
+def column_parser(column):
+    """
+    A function parsing query string values for a column, or None if they can
+    be used as they are.
+    """
+    from sqlalchemy import types
+    if isinstance(column.type, types.Integer):
+        return int
+    if isinstance(column.type, types.Numeric):
+        return Decimal if column.type.asdecimal else float
+    if isinstance(column.type, types.Boolean):
+        return parse_flag
+    if isinstance(column.type, types.DateTime):
+        return parse_datetime
+    if isinstance(column.type, types.Date):
+        return parse_date
+    if isinstance(column.type, types.Time):
+        return parse_time
+    return None
+
+
+def column_field(column):
+    """A Field checking values for a column by its type"""
+    from sqlalchemy import types
+    t = column.type
+    kind = None
+    max_length = None
+    if isinstance(t, types.Boolean):
+        kind = bool
+    elif isinstance(t, types.Integer):
+        kind = int
+    elif isinstance(t, types.Numeric):
+        kind = Decimal if t.asdecimal else float
+    elif isinstance(t, types.String):
+        kind = basestring
+        max_length = t.length
+    elif isinstance(t, types.DateTime):
+        kind = datetime
+    elif isinstance(t, types.Date):
+        kind = date
+    elif isinstance(t, types.Time):
+        kind = dt_time
+
+    # NB. columns with a default may be left out, but not set to null
+    required = column.default is None and column.server_default is None
+    return Field(kind, column.nullable, max_length, required)
+
+
 class SqlAlchemyEndpoint(Endpoint):
 
-    def __init__(self, db, cls, items):
-        from sqlalchemy.orm import class_mapper
+    def __init__(self, db, cls, items, version_key=None, modified_key=None,
+                 filterable_keys=None, sortable_keys=None):
+        """
+        version_key:     Column holding a version number/tag, used as ETag
+        modified_key:    Column holding the last modification datetime
+        filterable_keys: Columns lists may be filtered on, defaults to those
+                         that are indexed
+        sortable_keys:   Columns lists may be sorted by, defaults to those
+                         that are indexed
+        """
+        from sqlalchemy.orm import class_mapper, ColumnProperty
         self.db = db
-        self.pk = class_mapper(cls).primary_key[0]
-        super(SqlAlchemyEndpoint, self).__init__(cls, self.pk.name, items)
+        self.mapper = class_mapper(cls)
+        self.pk = self.mapper.primary_key[0]
+        self._parse_pk = column_parser(self.pk) or (lambda path: path)
+        self.version_key = version_key
+        self.modified_key = modified_key
+        self._serializers = None
+        self._statements = LRUCache(max_size=128)
+
+        indexed = [p.key for p in self.mapper.iterate_properties \
+            if isinstance(p, ColumnProperty) and \
+                any(c.primary_key or c.index or c.unique for c in p.columns)]
+        super(SqlAlchemyEndpoint, self).__init__(
+            cls, self.pk.name, items,
+            indexed if filterable_keys is None else filterable_keys,
+            indexed if sortable_keys is None else sortable_keys)
+
+    def compile(self):
+        from sqlalchemy.orm import class_mapper, ColumnProperty
+        self._columns = [(p.key, p.columns[0]) for p in \
+            class_mapper(self.cls).iterate_properties \
+            if isinstance(p, ColumnProperty)]
+        self._serializers = LRUCache(max_size=64)
+        self._serializers.set(None, self._compile_serializer(None))
+        self._versions = self._version_columns()
+        self._key_names = frozenset(n for n, c in self._columns)
+        super(SqlAlchemyEndpoint, self).compile()
+
+    def is_key(self, key):
+        return key in self._key_names
+
+    def parse_key(self, path):
+        try:
+            return self._parse_pk(path)
+        except (TypeError, ValueError):
+            return path
+
+    def _version_columns(self):
+        """
+        The (key, column) of the mapper's version_id_col and of version_key,
+        which UPDATEs must move on; None if one is not an integer, so that
+        only the ORM can.
+        """
+        from sqlalchemy import types
+        columns = []
+        if self.mapper.version_id_col is not None:
+            columns.append(self.mapper.version_id_col)
+        if self.version_key is not None:
+            columns.append(self._column(self.version_key))
+
+        versions = []
+        for column in set(columns):
+            if not isinstance(column.type, types.Integer):
+                return None
+            versions.append(
+                (self.mapper.get_property_by_column(column).key, column))
+        return versions
+
+    def _version_bumps(self, keys):
+        """
+        The (key, column) of versions an UPDATE writing keys must move on,
+        or None if the object must be loaded for the ORM to do so.
+        """
+        if not hasattr(self, '_versions'):
+            self._versions = self._version_columns()
+        if self._versions is None:
+            return None
+        return [(k, c) for k, c in self._versions if k not in keys]
+
+    def _versioned(self, data):
+        """
+        Values for an UPDATE of the row with data, moving on its version unless
+        written; None if the object must be loaded for the ORM to do so.
+        """
+        bumps = self._version_bumps(data)
+        if bumps is None:
+            return None
+        values = dict(data)
+        values.update((k, c + 1) for k, c in bumps)
+        return values
+
+    def schema(self):
+        """Fields typed from the columns of writeable keys"""
+        columns = dict((p.key, p.columns[0]) for p in
+                       self.mapper.iterate_properties if hasattr(p, 'columns'))
+        return dict((k, column_field(columns[k]) if k in columns else Field())
+                    for k in self.writeable_keys or ())
+
+    def _compile_serializer(self, fields):
+        """
+        Build a function converting an object to a dict of its columns, or of
+        its items if the class is iterable.
+        """
+        if hasattr(self.cls, '__iter__'):
+            if fields is None:
+                return dict
+            return lambda o: dict((k, v) for k, v in o if k in fields)
+
+        columns = [(n, c) for n, c in self._columns \
+            if fields is None or n in fields]
+        names = tuple(n for n, c in columns)
+        if not names:
+            return lambda o: dict()
+
+        get = attrgetter(*names)
+        if len(names) == 1:
+            get = lambda o, get=get: (get(o),)
+
+        converters = [column_converter(c) for n, c in columns]
+        if not any(converters):
+            return lambda o: dict(izip(names, get(o)))
+
+        pairs = zip(names, converters)
+
+        def serialize(o):
+            return dict((n, v if f is None or v is None else f(v)) \
+                for (n, f), v in izip(pairs, get(o)))
+        return serialize
+
+    def serialize(self, obj, fields=None):
+        if self._serializers is None:
+            self.compile()
+
+        key = None if fields is None else frozenset(fields)
+        f = self._serializers.get(key)
+        if f is None:
+            f = self._compile_serializer(key)
+            self._serializers.set(key, f)
+        return f(obj)
+
+    def _key(self, path):
+        """Coerce a path to the type of the primary key"""
+        try:
+            return self._parse_pk(path)
+        except (TypeError, ValueError):
+            raise NotFoundError(self.cls, path)
+
+    def _keys(self, paths):
+        """Coerce paths to the type of the primary key, skipping bad ones"""
+        keys = []
+        for path in paths:
+            try:
+                keys.append(self._parse_pk(path))
+            except (TypeError, ValueError):
+                pass
+        return keys
 
     def create(self, path=None):
         o = self.cls()
         if path is not None:
+            try:
+                path = self._parse_pk(path)
+            except (TypeError, ValueError):
+                pass
             setattr(o, self.id_key, path)
         return o
 
@@ -320,15 +3159,368 @@ class SqlAlchemyEndpoint(Endpoint):
             return [pk[0] for pk in \
                 self.db.session.query(self.pk).all()]
 
-        try:
-            return self.cls.query.filter(self.pk == path).all()[0]
-        except IndexError:
+        # NB. get() is answered from the session's identity map if possible
+        o = self.cls.query.get(self._key(path))
+        if o is None:
             raise NotFoundError(self.cls, path)
+        return o
+
+    def read_many(self, paths):
+        keys = self._keys(paths)
+        if not keys:
+            return []
+
+        found = {}
+        for n in range(0, len(keys), 500):
+            found.update((getattr(o, self.id_key), o) for o in \
+                self.cls.query.filter(self.pk.in_(keys[n:n + 500])))
+        return [found[k] for k in keys if k in found]
+
+    def read_partial(self, paths, fields):
+        if self._serializers is None:
+            self.compile()
+        keys = self._keys(paths)
+        if not keys or hasattr(self.cls, '__iter__'):
+            return super(SqlAlchemyEndpoint, self).read_partial(keys, fields)
+
+        # query bare columns rather than entities to skip the identity map
+        columns = [(n, c) for n, c in self._columns if n in fields]
+        pairs = [(n, column_converter(c)) for n, c in columns]
+        q = self.db.session.query(self.pk, *[c for n, c in columns])
+
+        found = {}
+        for i in range(0, len(keys), 500):
+            for row in q.filter(self.pk.in_(keys[i:i + 500])):
+                found[row[0]] = dict(
+                    (n, v if f is None or v is None else f(v)) \
+                        for (n, f), v in izip(pairs, row[1:]))
+        return [found[k] for k in keys if k in found]
+
+    def read_keys(self, after=None, limit=None, filters=None, order=None):
+        filters = filters or ()
+        shape = (filter_shape(filters),
+                 tuple(order or ()),
+                 after is not None,
+                 limit)
+
+        conn = self.db.session.connection(mapper=self.mapper)
+        compiled = self._statements.get(shape)
+        if compiled is None:
+            compiled = self._keys_statement(*shape).compile(
+                dialect=conn.dialect)
+            self._statements.set(shape, compiled)
+
+        params = self._filter_params(filters, after)
+        return [row[0] for row in conn.execute(compiled, params)]
+
+    def iter_chunks(self, after=None, limit=None, filters=None,
+                    chunk_size=1000):
+        from sqlalchemy import and_
+        filters = filters or ()
+        q = self.cls.query.order_by(self.pk)
+        clauses = self._filter_clauses(filter_shape(filters),
+                                       after is not None)
+        if clauses:
+            q = q.filter(and_(*clauses)) \
+                .params(self._filter_params(filters, after))
+        if limit is not None:
+            q = q.limit(limit)
+
+        # NB. yield_per also asks for a server-side cursor (stream_results)
+        q = q.yield_per(chunk_size)
+
+        def generate():
+            chunk = []
+            for o in q:
+                chunk.append(o)
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+        return generate()
+
+    def _filter_params(self, filters, after):
+        """Parse filter values into parameters for a filter statement"""
+        params = {}
+        try:
+            for i, (k, op, v) in enumerate(filters):
+                parse = column_parser(self._column(k)) or (lambda a: a)
+                if op == 'in':
+                    for j, a in enumerate(v):
+                        params['f%d_%d' % (i, j)] = parse(a)
+                else:
+                    params['f%d' % i] = parse(v)
+            if after is not None:
+                params['after'] = self._parse_pk(after)
+        except ValueError, e:
+            raise BadRequestError('Invalid value in filter: %s' % e.message)
+        return params
+
+    def _column(self, key):
+        return self.mapper.get_property(key).columns[0]
+
+    def write_many(self, ops):
+        """
+        Apply writes in a single transaction with as few statements as
+        possible: one SELECT to find existing rows, executemany INSERTs and
+        UPDATEs grouped by the keys written, and one DELETE. Should a key come
+        up again, the statements so far are run first, keeping the order of
+        writes to it. POSTing a key that exists gives a 409.
+
+        NB. this works on the table directly, so ORM-level events and
+        validators are not run.
+        """
+        from sqlalchemy import select, bindparam
+        table = self.pk.table
+        parse = column_parser(self.pk) or (lambda a: a)
+        conn = self.db.session.connection(mapper=self.mapper)
+
+        def row(data):
+            return dict((self._column(k).key, v) for k, v in data.iteritems())
+
+        results = [None] * len(ops)
+        keys = {}
+        for i, (method, path, data) in enumerate(ops):
+            if path is not None:
+                try:
+                    keys[i] = parse(path)
+                except (TypeError, ValueError):
+                    results[i] = (404, path)
+
+        existing = set()
+        lookup = list(set(keys.itervalues()))
+        for n in range(0, len(lookup), 500):
+            existing.update(pk for (pk,) in conn.execute(
+                select([self.pk]).where(self.pk.in_(lookup[n:n + 500]))))
+
+        # NB. the ORM would start the mapper's version at 1, do so too
+        version = self.mapper.version_id_col
+        initial = {} if version is None else {version.key: 1}
+
+        inserts = []
+        updates = {}
+        deletes = []
+        touched = set()
+
+        def flush():
+            if inserts:
+                conn.execute(table.insert(), inserts)
+            for written, group in updates.iteritems():
+                # NB. versions the ORM must move on are left as they are
+                bumps = self._version_bumps(written) or ()
+                conn.execute(table.update().where(
+                    self.pk == bindparam('_pk', type_=self.pk.type)).values(
+                    dict((c, c + 1) for k, c in bumps)), group)
+            for n in range(0, len(deletes), 500):
+                conn.execute(table.delete().where(
+                    self.pk.in_(deletes[n:n + 500])))
+            del inserts[:], deletes[:]
+            updates.clear()
+            touched.clear()
+
+        try:
+            for i, (method, path, data) in enumerate(ops):
+                if results[i] is not None:
+                    continue
+                key = keys.get(i)
+                if key is not None:
+                    if key in touched:
+                        flush()
+                    touched.add(key)
+
+                if method == 'POST' and key is None:
+                    # NB. inserted one at a time to learn the generated key
+                    values = dict(initial)
+                    values.update(row(data))
+                    r = conn.execute(table.insert(), values)
+                    results[i] = (201, r.inserted_primary_key[0])
+                elif method == 'POST' and key in existing:
+                    results[i] = (409, key)
+                elif method in ('POST', 'PUT') and key not in existing:
+                    values = dict(initial)
+                    values.update(row(data))
+                    values[self.pk.key] = key
+                    inserts.append(values)
+                    existing.add(key)
+                    results[i] = (201, key)
+                elif key not in existing:
+                    results[i] = (404, path)
+                elif method == 'DELETE':
+                    deletes.append(key)
+                    existing.discard(key)
+                    results[i] = (200, key)
+                else:
+                    values = row(data)
+                    values['_pk'] = key
+                    updates.setdefault(tuple(sorted(data)), []).append(values)
+                    results[i] = (200, key)
+
+            flush()
+            self.db.session.commit()
+        except:
+            self.db.session.rollback()
+            raise
+
+        return results
+
+    def _keys_statement(self, filters, order, after, limit):
+        """
+        Build a parameterized SELECT of keys for a shape of filters, so that
+        it is compiled once and reused for requests differing only in values.
+        """
+        from sqlalchemy import select, and_
+
+        stmt = select([self.pk])
+        clauses = self._filter_clauses(filters, after)
+        if clauses:
+            stmt = stmt.where(and_(*clauses))
+        stmt = stmt.order_by(*[self._column(k).desc() if desc \
+            else self._column(k) for k, desc in order] + [self.pk])
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        return stmt
+
+    def _filter_clauses(self, filters, after):
+        """Build clauses for a shape of filters, with values as bindparams"""
+        from sqlalchemy import bindparam
+
+        clauses = []
+        for i, (k, op, n) in enumerate(filters):
+            col = self._column(k)
+            if op == 'in':
+                clauses.append(col.in_([
+                    bindparam('f%d_%d' % (i, j), type_=col.type) \
+                        for j in range(n)]))
+            else:
+                clauses.append(FILTER_OPERATORS[op](
+                    col, bindparam('f%d' % i, type_=col.type)))
+        if after:
+            clauses.append(self.pk > bindparam('after', type_=self.pk.type))
+        return clauses
+
+    def etag(self, obj):
+        if self.version_key is None:
+            return None
+        return unicode(getattr(obj, self.version_key))
+
+    def last_modified(self, obj):
+        if self.modified_key is None:
+            return None
+        return getattr(obj, self.modified_key)
 
     def finalize(self, obj):
+        from sqlalchemy.orm.attributes import set_committed_value, \
+            instance_state
+        state = instance_state(obj)
+        if state.has_identity:
+            # NB. the ORM moves on the mapper's version_id_col itself, but not
+            #     a version_key, so have the UPDATE do so unless it is written
+            for key, column in self._version_bumps(state.committed_state) \
+                    or ():
+                if column is not self.mapper.version_id_col:
+                    setattr(obj, key, column + 1)
         self.db.session.add(obj)
+        self.db.session.flush()
+        key = getattr(obj, self.id_key)
+        self.db.session.commit()
+        # NB. the key is commonly read straight after, e.g. for Location, so
+        #     keep it rather than have the expired object reloaded
+        set_committed_value(obj, self.id_key, key)
+
+    def update(self, path, data):
+        """
+        A single UPDATE of the row, without loading it first.
+
+        NB. as with write_many, ORM-level events and validators are not run.
+        """
+        values = self._versioned(data) if data else None
+        if data and values is None:
+            return super(SqlAlchemyEndpoint, self).update(path, data)
+
+        q = self.cls.query.filter(self.pk == self._key(path))
+        if values:
+            count = q.update(values, synchronize_session='evaluate')
+        else:
+            count = q.count()
+
+        if not count:
+            self.db.session.rollback()
+            raise NotFoundError(self.cls, path)
         self.db.session.commit()
 
+    def update_matching(self, path, data, etags):
+        """
+        A single UPDATE of the row where its integer version_key is one of
+        etags, moving the version on.
+        """
+        if self.version_key is None or not self._version_bumps(()):
+            return None
+
+        tags = []
+        for tag in etags:
+            try:
+                tags.append(int(tag))
+            except ValueError:
+                pass
+
+        q = self.cls.query.filter(self.pk == self._key(path))
+        count = 0
+        if tags:
+            count = q.filter(self._column(self.version_key).in_(tags)) \
+                .update(self._versioned(data), synchronize_session=False)
+        if count:
+            self.db.session.commit()
+            return True
+
+        self.db.session.rollback()
+        if not q.count():
+            raise NotFoundError(self.cls, path)
+        return False
+
+    def upsert(self, path, data):
+        """
+        An UPDATE of the row, followed by an INSERT in the same transaction
+        if there was nothing to update; should another request insert the row
+        first, it is updated instead.
+        """
+        from sqlalchemy.exc import IntegrityError
+        values = self._versioned(data) if data else None
+        if data and values is None:
+            return super(SqlAlchemyEndpoint, self).upsert(path, data)
+
+        q = self.cls.query.filter(self.pk == self._key(path))
+        for retry in False, True:
+            if values:
+                count = q.update(values, synchronize_session='evaluate')
+            else:
+                count = q.count()
+
+            if count:
+                self.db.session.commit()
+                return False
+
+            o = self.create(path)
+            for k in data:
+                setattr(o, k, data[k])
+            try:
+                self.finalize(o)
+                return True
+            except IntegrityError:
+                self.db.session.rollback()
+                if retry:
+                    raise
+
     def delete(self, path):
-        o = self.read(path)
-        self.db.session.delete(o)
+        """
+        A single DELETE of the row, without loading it first.
+
+        NB. ORM-level cascades are not run, rely on those of the database.
+        """
+        count = self.cls.query.filter(self.pk == self._key(path)) \
+            .delete(synchronize_session='evaluate')
+
+        if not count:
+            self.db.session.rollback()
+            raise NotFoundError(self.cls, path)
+        self.db.session.commit()
@@ -30,6 +30,12 @@ setup(
     install_requires=[
         'Flask>=0.8',
     ],
+    extras_require={
+        'msgpack': ['msgpack>=0.5.2'],
+        'cbor': ['cbor2>=4.0'],
+        'brotli': ['Brotli'],
+        'zstd': ['zstandard'],
+    },
     tests_require=[
         'Flask-Testing>=0.3',
         'nose>=1.1.2',
@@ -1,14 +1,40 @@
 # coding: utf-8
-from unittest import TestCase
-from flask import Flask
+from unittest import TestCase, skipIf
+from collections import namedtuple
+from datetime import datetime, date
+from decimal import Decimal
+import zlib
+import time
+from flask import Flask, request
 from flask.ext.testing import TestCase as FlaskTestCase
-from flask.ext.snooze import Snooze, Endpoint
+from flask.ext.snooze import Snooze, Endpoint, LRUCache, CachedEndpoint, \
+    Bulkhead, SingleFlight, CoalescedEndpoint, Metrics, PrometheusMetrics, \
+    StatsdMetrics, Profiler, JSONCodec, select_json_backend, MsgPackCodec, \
+    CBORCodec, Compression, CORS, Schema, Field, ValidationError, \
+    RateLimiter, MemoryRateLimitStore
+from threading import Thread, Event
+from contextlib import contextmanager
 
 try:
     import simplejson as json
 except ImportError:
     import json
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 """
 Api Manager Tests
 HTTP Protocol reference: http://www.w3.org/Protocols/rfc2616/rfc2616-sec9.html
@@ -94,6 +120,15 @@ def print_tb(response):
         pass  # don't care
 
 
+def wait_for(case, condition, timeout=5):
+    """Wait for condition() to hold, failing case if it does not in time"""
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            case.fail('Timed out after %s seconds' % timeout)
+        time.sleep(0.001)
+
+
 class TestSnoozeDirect(TestCase):
 
     """
@@ -195,6 +230,19 @@ class TestSnoozeHttp(FlaskTestCase):
         self.assertIsInstance(response.json, list)
 
 
+    def test_list_paged(self):
+        apimgr = self.create_mgr()
+        apimgr.add(DummyEndpoint(object, None, None))
+        response = self.client.get('/object/?limit=10')
+        self.assertEqual(response.json, [])
+        self.assertNotIn('Link', response.headers)
+
+    def test_list_stream(self):
+        apimgr = self.create_mgr()
+        apimgr.add(DummyEndpoint(object, None, None))
+        response = self.client.get('/object/?stream=1')
+        self.assertEqual(json.loads(response.data), [])
+
 class TestExerciseEndpoint(FlaskTestCase):
 
     """
@@ -216,12 +264,14 @@ class TestExerciseEndpoint(FlaskTestCase):
     def test_post_no_path(self):
         path = ''
         self.client.post('/object/%s' % path)
-        self.assertEqual(self.endpoint.calls, [('create', dict(path=None))])
+        self.assertEqual(self.endpoint.calls, [('create', dict(path=None)),
+                                               ('finalize', dict(obj=None))])
 
     def test_post_path(self):
         path = 'foo'
         self.client.post('/object/%s' % path)
-        self.assertEqual(self.endpoint.calls, [('create', dict(path=path))])
+        self.assertEqual(self.endpoint.calls, [('create', dict(path=path)),
+                                               ('finalize', dict(obj=None))])
 
     def test_get_no_path(self):
         path = ''
@@ -233,14 +283,65 @@ class TestExerciseEndpoint(FlaskTestCase):
         self.client.get('/object/%s' % path)
         self.assertEqual(self.endpoint.calls, [('read', dict(path=path))])
 
+    def test_get_ids(self):
+        self.client.get('/object/?ids=foo,bar')
+        self.assertEqual(self.endpoint.calls, [('read', dict(path='foo')),
+                                               ('read', dict(path='bar'))])
+
+    def test_get_filter(self):
+        Item = namedtuple('Item', 'id')
+        self.endpoint.id_key = 'id'
+        self.endpoint.filterable_keys = ['id']
+        self.endpoint.sortable_keys = ['id']
+        self.endpoint.read = lambda path: [1, 2, -3] if path is None \
+            else Item(int(path))
+        response = self.client.get('/object/?id__gt=1')
+        self.assertEqual(response.json, [2])
+        response = self.client.get('/object/?sort=-id')
+        self.assertEqual(response.json, [2, 1, -3])
+
+    def test_get_filter_400(self):
+        self.endpoint.writeable_keys = ['foo']
+        self.assert_400(self.client.get('/object/?foo=bar'))
+
+    def test_get_limit_400(self):
+        for limit in 'abc', '-1', '0':
+            self.assert_400(self.client.get('/object/?limit=%s' % limit))
+
+    def test_get_other_args(self):
+        self.assert_200(self.client.get('/object/?_=123'))
+
+    def test_bulk(self):
+        data_in = json.dumps([
+            dict(method='DELETE', id='foo'),
+            dict(method='TRACE', id='foo'),
+        ])
+        response = self.client.post('/object/_bulk', data=data_in)
+        self.assertEqual([r['status'] for r in response.json], [200, 400])
+        self.assertEqual(self.endpoint.calls, [('delete', dict(path='foo'))])
+
+    def test_bulk_bad_id(self):
+        data_in = json.dumps([
+            dict(method='DELETE', id=1.5),
+            dict(method='DELETE', id=True),
+            dict(method='DELETE', id=['foo']),
+            dict(method='DELETE', id=1),
+        ])
+        response = self.client.post('/object/_bulk', data=data_in)
+        self.assertEqual([r['status'] for r in response.json],
+                         [400, 400, 400, 200])
+        self.assertEqual(self.endpoint.calls, [('delete', dict(path=1))])
+
     def test_put_no_path(self):
         path = ''
         self.assert_status(self.client.put('/object/%s' % path), 405)
 
     def test_put_path(self):
         path = 'foo'
+        self.endpoint.writeable_keys = []
         self.client.put('/object/%s' % path)
-        self.assertEqual(self.endpoint.calls, [('read', dict(path=path))])
+        self.assertEqual(self.endpoint.calls, [('read', dict(path=path)),
+                                               ('finalize', dict(obj=None))])
 
     def test_patch_no_path(self):
         path = ''
@@ -260,3 +361,1100 @@ class TestExerciseEndpoint(FlaskTestCase):
         path = 'foo'
         self.client.delete('/object/%s' % path)
         self.assertEqual(self.endpoint.calls, [('delete', dict(path=path))])
+
+
+class TestLRUCache(TestCase):
+
+    """
+    Exercise the in-process cache backend.
+    """
+
+    def test_get_set(self):
+        cache = LRUCache()
+        self.assertIs(cache.get('a'), None)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        cache.delete('a')
+        self.assertIs(cache.get('a'), None)
+
+    def test_evict_least_recent(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIs(cache.get('b'), None)
+        self.assertEqual(cache.stats(), dict(size=2, evictions=1))
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=-1)
+        cache.set('a', 1)
+        self.assertIs(cache.get('a'), None)
+
+
+class TestCachedEndpoint(FlaskTestCase):
+
+    """
+    Ensure that reads are cached and writes invalidate them.
+    """
+
+    def create_app(self):
+        """Create a Flask app"""
+        self.app = Flask(__name__)
+        self.app.config['TESTING'] = True
+        return self.app
+
+    def setUp(self):
+        self.endpoint = DummyEndpoint(object, None, None)
+        self.cached = CachedEndpoint(self.endpoint)
+        self.mgr = Snooze(self.app)
+        self.mgr.add(self.cached, 'object')
+
+    def test_get_cached(self):
+        self.endpoint.read = lambda path: dict(path=path)
+        self.client.get('/object/foo')
+        self.endpoint.read = None
+        self.assertEqual(self.client.get('/object/foo').json, dict(path='foo'))
+        self.assertEqual(self.cached.stats()['hits'], 1)
+        self.assertEqual(self.cached.stats()['misses'], 1)
+
+    def test_concurrent_stats(self):
+        self.endpoint.read = lambda path: dict(path=path)
+
+        def read():
+            with self.app.test_request_context():
+                for i in range(1000):
+                    self.cached.read(str(i % 10))
+        threads = [Thread(target=read) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats = self.cached.stats()
+        self.assertEqual(stats['hits'] + stats['misses'], 4000)
+
+    def test_delete_invalidates(self):
+        self.endpoint.read = lambda path: dict(path=path)
+        self.client.get('/object/foo')
+        self.client.delete('/object/foo')
+        self.client.get('/object/foo')
+        self.assertEqual(self.cached.stats()['misses'], 2)
+
+
+class TestBodyCache(FlaskTestCase):
+
+    """
+    Ensure that encoded bodies are cached and writes invalidate them.
+    """
+
+    def create_app(self):
+        """Create a Flask app"""
+        self.app = Flask(__name__)
+        self.app.config['TESTING'] = True
+        return self.app
+
+    def setUp(self):
+        self.endpoint = DummyEndpoint(object, None, None)
+        self.reads = []
+        self.endpoint.read = lambda path: self.reads.append(path) or \
+            dict(path=path, reads=len(self.reads))
+        self.cache = LRUCache(max_size=10)
+        self.mgr = Snooze(self.app, body_cache=self.cache)
+        self.mgr.add(self.endpoint)
+
+    def test_get_cached(self):
+        self.assertEqual(self.client.get('/object/foo').json['reads'], 1)
+        response = self.client.get('/object/foo')
+        self.assertEqual(response.json['reads'], 1)
+        self.assertIn('ETag', response.headers)
+        self.assertEqual(self.client.get('/object/bar').json['reads'], 2)
+
+    def test_get_cached_conditional(self):
+        etag = self.client.get('/object/foo').headers['ETag']
+        response = self.client.get('/object/foo',
+                                   headers={'If-None-Match': etag})
+        self.assertStatus(response, 304)
+
+    def test_query_variants(self):
+        self.client.get('/object/foo')
+        self.assertEqual(self.client.get('/object/foo?x=1').json['reads'], 2)
+        self.assertEqual(self.client.get('/object/foo').json['reads'], 1)
+
+    def test_many_variants(self):
+        for n in range(50):
+            self.client.get('/object/foo?_=%d' % n)
+        self.assertEqual(self.cache.stats()['size'], 10)
+        self.assertGreater(self.cache.stats()['evictions'], 0)
+        self.assertEqual(self.client.get('/object/foo?_=49').json['reads'], 50)
+
+    def test_delete_invalidates(self):
+        self.client.get('/object/foo')
+        self.client.delete('/object/foo')
+        self.assertEqual(self.client.get('/object/foo').json['reads'], 2)
+
+
+class TestBulkhead(FlaskTestCase):
+
+    """
+    Ensure that concurrent calls into an endpoint are limited.
+    """
+
+    def create_app(self):
+        """Create a Flask app"""
+        self.app = Flask(__name__)
+        self.app.config['TESTING'] = True
+        return self.app
+
+    def setUp(self):
+        self.endpoint = DummyEndpoint(object, None, None)
+        self.mgr = Snooze(self.app)
+
+    def test_call(self):
+        bulkhead = Bulkhead(1)
+        self.mgr.add(self.endpoint, bulkhead=bulkhead)
+        self.assert_200(self.client.get('/object/foo'))
+        self.assertEqual(bulkhead.stats()['calls'], 1)
+        self.assertEqual(bulkhead.stats()['active'], 0)
+
+    def test_queue_timeout(self):
+        bulkhead = Bulkhead(1, queue_timeout=0, retry_after=5)
+        self.mgr.add(self.endpoint, bulkhead=bulkhead)
+        bulkhead.acquire()
+        response = self.client.get('/object/foo')
+        self.assertStatus(response, 503)
+        self.assertEqual(response.headers['Retry-After'], '5')
+        self.assertEqual(bulkhead.stats()['rejected'], 1)
+        bulkhead.release()
+        self.assert_200(self.client.get('/object/foo'))
+
+    def test_queue(self):
+        bulkhead = Bulkhead(1)
+        bulkhead.acquire()
+        t = Thread(target=bulkhead.acquire)
+        t.start()
+        wait_for(self, lambda: bulkhead.stats()['queued'] > 0)
+        bulkhead.release()
+        t.join(1)
+        self.assertEqual(bulkhead.stats()['active'], 1)
+        self.assertEqual(bulkhead.stats()['queued'], 0)
+
+    def test_pool(self):
+        bulkhead = Bulkhead(2, pool_size=2)
+        self.mgr.add(self.endpoint, bulkhead=bulkhead)
+        self.endpoint.read = lambda path: dict(path=path,
+                                               args=request.args.get('x'))
+        response = self.client.get('/object/foo?x=1')
+        self.assertEqual(response.json, dict(path='foo', args='1'))
+
+    def test_pool_timeout(self):
+        bulkhead = Bulkhead(1, pool_size=1, call_timeout=0.01)
+        self.mgr.add(self.endpoint, bulkhead=bulkhead)
+        event = Event()
+        self.endpoint.read = lambda path: event.wait(1)
+        self.assertStatus(self.client.get('/object/foo'), 503)
+        self.assertEqual(bulkhead.stats()['timeouts'], 1)
+        self.assertEqual(bulkhead.stats()['active'], 1)
+        event.set()
+
+    def test_stream(self):
+        bulkhead = Bulkhead(1)
+        self.mgr.add(self.endpoint, bulkhead=bulkhead)
+        response = self.client.get('/object/?stream=1')
+        self.assertEqual(bulkhead.stats()['active'], 1)
+        self.assertEqual(json.loads(response.data), [])
+        response.close()
+        self.assertEqual(bulkhead.stats()['active'], 0)
+
+    def test_pool_stream(self):
+        bulkhead = Bulkhead(1, pool_size=1)
+        self.mgr.add(self.endpoint, bulkhead=bulkhead)
+        response = self.client.get('/object/?stream=1')
+        self.assertEqual(bulkhead.stats()['active'], 1)
+        response.close()
+        self.assertEqual(bulkhead.stats()['active'], 0)
+
+
+class TestSingleFlight(TestCase):
+
+    """
+    Ensure that concurrent calls for a key are collapsed.
+    """
+
+    def setUp(self):
+        self.flight = SingleFlight()
+        self.started = Event()
+        self.release = Event()
+        self.calls = []
+
+    def slow(self, value):
+        self.calls.append(value)
+        self.started.set()
+        self.release.wait(1)
+        if value is None:
+            raise ValueError('no value')
+        return value
+
+    def run_concurrently(self, value, n=3):
+        results = []
+
+        def call():
+            try:
+                results.append(self.flight.do('key', self.slow, value))
+            except ValueError, e:
+                results.append(e)
+
+        leader = Thread(target=call)
+        leader.start()
+        self.started.wait(1)
+        followers = [Thread(target=call) for _ in range(n - 1)]
+        for t in followers:
+            t.start()
+        wait_for(self, lambda: self.flight.stats()['shared'] >= n - 1)
+        self.release.set()
+        for t in [leader] + followers:
+            t.join(1)
+        return results
+
+    def test_shared_result(self):
+        self.assertEqual(self.run_concurrently('a'), ['a', 'a', 'a'])
+        self.assertEqual(self.calls, ['a'])
+        self.assertEqual(self.flight.stats(),
+                         dict(calls=1, shared=2, in_flight=0))
+
+    def test_shared_error(self):
+        results = self.run_concurrently(None)
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+        self.assertEqual(self.calls, [None])
+
+    def test_sequential(self):
+        self.release.set()
+        self.flight.do('key', self.slow, 'a')
+        self.flight.do('key', self.slow, 'b')
+        self.assertEqual(self.calls, ['a', 'b'])
+
+
+class TestCoalescedEndpoint(FlaskTestCase):
+
+    """
+    Ensure that concurrent identical GETs make a single read.
+    """
+
+    def create_app(self):
+        """Create a Flask app"""
+        self.app = Flask(__name__)
+        self.app.config['TESTING'] = True
+        return self.app
+
+    def setUp(self):
+        self.endpoint = DummyEndpoint(object, None, None)
+        self.mgr = Snooze(self.app)
+        self.flight = SingleFlight()
+        self.mgr.add(self.endpoint, coalesce=self.flight)
+
+    def test_get(self):
+        self.assert_200(self.client.get('/object/foo'))
+        self.assertEqual(self.endpoint.calls, [('read', dict(path='foo'))])
+        self.assertEqual(self.flight.stats()['calls'], 1)
+
+    def test_stream(self):
+        self.endpoint.read = lambda path: ['a', 'b'] if path is None else \
+            dict(path=path)
+        with no_request_context(self):
+            response = self.client.get('/object/?stream=1')
+            self.assertEqual(json.loads(response.data), ['a', 'b'])
+
+    def test_concurrent_get(self):
+        release = Event()
+        reads = []
+
+        def read(path):
+            reads.append(path)
+            release.wait(1)
+            return dict(path=path)
+        self.endpoint.read = read
+
+        responses = []
+
+        def get():
+            responses.append(self.app.test_client().get('/object/foo'))
+
+        threads = [Thread(target=get) for _ in range(3)]
+        for t in threads:
+            t.start()
+        wait_for(self, lambda: self.flight.stats()['shared'] >= 2)
+        release.set()
+        for t in threads:
+            t.join(1)
+
+        self.assertEqual([r.status_code for r in responses], [200] * 3)
+        self.assertEqual(reads, ['foo'])
+
+    def test_write_not_coalesced(self):
+        coalesced = CoalescedEndpoint(self.endpoint)
+        with self.app.test_request_context(method='DELETE'):
+            coalesced.delete('foo')
+            coalesced.read('foo')
+        self.assertEqual(coalesced.stats()['calls'], 0)
+
+
+class RecordingMetrics(Metrics):
+
+    def __init__(self):
+        self.events = []
+
+    def start(self, name, verb):
+        self.events.append(('start', name, verb))
+
+    def finish(self, name, verb, timings, status):
+        self.events.append(('finish', name, verb, sorted(timings), status))
+
+
+class TestMetrics(FlaskTestCase):
+
+    """
+    Ensure that request timings are given to a metrics sink.
+    """
+
+    def create_app(self):
+        """Create a Flask app"""
+        self.app = Flask(__name__)
+        self.app.config['TESTING'] = True
+        return self.app
+
+    def setUp(self):
+        self.endpoint = DummyEndpoint(object, None, None)
+
+    def test_sink(self):
+        metrics = RecordingMetrics()
+        Snooze(self.app, metrics=metrics).add(self.endpoint)
+        self.client.get('/object/foo')
+        self.assertEqual(metrics.events, [
+            ('start', 'object', 'GET'),
+            ('finish', 'object', 'GET',
+             ['decode', 'encode', 'endpoint', 'total'], 200),
+        ])
+
+    def test_sink_error(self):
+        metrics = RecordingMetrics()
+        Snooze(self.app).add(self.endpoint, metrics=metrics)
+        self.endpoint.read = lambda path: 1 / 0
+        self.client.get('/object/foo')
+        self.assertEqual(metrics.events[-1],
+                         ('finish', 'object', 'GET', ['decode', 'total'], 500))
+
+    def test_prometheus(self):
+        metrics = PrometheusMetrics(buckets=(1, 10))
+        Snooze(self.app, metrics=metrics).add(self.endpoint)
+        self.client.get('/object/foo')
+        self.client.get('/object/foo')
+        self.endpoint.read = lambda path: 1 / 0
+        self.client.get('/object/foo')
+
+        response = self.client.get('/_metrics')
+        self.assert_200(response)
+        lines = response.data.splitlines()
+        self.assertIn('snooze_seconds_bucket{endpoint="object",phase="total",'
+                      'verb="GET",le="1.0"} 3', lines)
+        self.assertIn('snooze_seconds_bucket{endpoint="object",phase="total",'
+                      'verb="GET",le="+Inf"} 3', lines)
+        self.assertIn('snooze_seconds_count{endpoint="object",'
+                      'phase="endpoint",verb="GET"} 2', lines)
+        self.assertIn('snooze_errors_total{endpoint="object",status="500",'
+                      'verb="GET"} 1', lines)
+        self.assertIn('snooze_in_flight{endpoint="object",verb="GET"} 0',
+                      lines)
+
+    def test_statsd(self):
+        sent = []
+        metrics = StatsdMetrics(lambda *args: sent.append(args))
+        Snooze(self.app, metrics=metrics).add(self.endpoint)
+        self.client.get('/object/foo')
+        names = [(name, kind) for name, value, kind in sent]
+        self.assertEqual(sent[0], ('snooze.object.GET.in_flight', 1, 'g'))
+        self.assertEqual(sent[1], ('snooze.object.GET.in_flight', 0, 'g'))
+        self.assertIn(('snooze.object.GET.total', 'ms'), names)
+
+        self.endpoint.read = lambda path: 1 / 0
+        self.client.get('/object/foo')
+        self.assertEqual(sent[-1], ('snooze.object.GET.errors.500', 1, 'c'))
+
+    def test_no_route(self):
+        Snooze(self.app, metrics=RecordingMetrics())
+        self.assert_404(self.client.get('/_metrics'))
+
+
+class TestServerTiming(FlaskTestCase):
+
+    """
+    Ensure that request timings are given in a Server-Timing header.
+    """
+
+    def create_app(self):
+        """Create a Flask app"""
+        self.app = Flask(__name__)
+        self.app.config['TESTING'] = True
+        return self.app
+
+    def setUp(self):
+        self.endpoint = DummyEndpoint(object, None, None)
+
+    def test_header(self):
+        Snooze(self.app, server_timing=True).add(self.endpoint)
+        response = self.client.get('/object/foo')
+        self.assert_200(response)
+        phases = [p.split(';')[0] for p in
+                  response.headers['Server-Timing'].split(', ')]
+        self.assertEqual(phases, ['decode', 'endpoint', 'encode', 'total'])
+
+    def test_header_error(self):
+        Snooze(self.app, server_timing=True).add(self.endpoint)
+        self.endpoint.read = lambda path: 1 / 0
+        response = self.client.get('/object/foo')
+        self.assertStatus(response, 500)
+        self.assertIn('total;dur=', response.headers['Server-Timing'])
+
+    def test_no_header(self):
+        Snooze(self.app).add(self.endpoint)
+        self.assertNotIn('Server-Timing',
+                         self.client.get('/object/foo').headers)
+
+
+class TestProfiler(FlaskTestCase):
+
+    """
+    Ensure that requests are profiled when sampled or asked to be.
+    """
+
+    def create_app(self):
+        """Create a Flask app"""
+        self.app = Flask(__name__)
+        self.app.config['TESTING'] = True
+        return self.app
+
+    def setUp(self):
+        self.endpoint = DummyEndpoint(object, None, None)
+        self.stored = []
+
+    def test_not_profiled(self):
+        profiler = Profiler(secret='s3cret')
+        Snooze(self.app, profiler=profiler).add(self.endpoint)
+        self.client.get('/object/foo', headers={'X-Snooze-Profile': 'wrong'})
+        self.assertEqual(len(profiler.reports), 0)
+
+    def test_sampled(self):
+        profiler = Profiler(sample_rate=1.0,
+                            store=lambda *args: self.stored.append(args))
+        Snooze(self.app).add(self.endpoint, profiler=profiler)
+        response = self.client.get('/object/foo')
+        self.assertEqual(response.json, None)
+        self.assertEqual(len(profiler.reports), 1)
+        path, report = self.stored[0]
+        self.assertEqual(path, '/object/foo')
+        self.assertIn('(_get)', report)
+
+    def test_asked(self):
+        profiler = Profiler(secret='s3cret')
+        Snooze(self.app, profiler=profiler).add(self.endpoint)
+        response = self.client.get('/object/foo',
+                                   headers={'X-Snooze-Profile': 's3cret'})
+        self.assert_200(response)
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertIn('function calls', response.data)
+
+
+class TestJSONCodec(TestCase):
+
+    """
+    Ensure that the default codec round trips and coerces unknown types.
+    """
+
+    def setUp(self):
+        self.codec = JSONCodec()
+
+    def test_round_trip(self):
+        data = dict(a=[1, 2.5, None, True], b=u'caf\xe9')
+        encoded = self.codec.encode(data)
+        self.assertTrue(isinstance(encoded, str))
+        self.assertEqual(self.codec.decode(encoded), data)
+
+    def test_default(self):
+        class Model(object):
+            def __iter__(self):
+                return iter([('id', 1), ('on', date(2012, 1, 2))])
+
+        encoded = self.codec.encode([
+            datetime(2012, 1, 2, 3, 4, 5), Decimal('1.5'), Model()])
+        self.assertEqual(json.loads(encoded), [
+            '2012-01-02T03:04:05', 1.5, dict(id=1, on='2012-01-02')])
+
+    def test_unencodable(self):
+        self.assertRaises(TypeError, self.codec.encode, object())
+
+    def test_select_backend(self):
+        name, loads, encoder = select_json_backend(('nonexistent', 'json'))
+        self.assertEqual(name, 'json')
+        codec = JSONCodec(backend=(name, loads, encoder))
+        self.assertEqual(codec.encode(dict(a=1)), '{"a":1}')
+        self.assertRaises(ImportError, select_json_backend, ('nonexistent',))
+
+
+class ReprCodec(object):
+
+    mimetype = 'text/x-repr'
+    array = None
+
+    def decode(self, data):
+        from ast import literal_eval
+        return literal_eval(data)
+
+    def encode(self, obj):
+        return repr(obj)
+
+
+@contextmanager
+def no_request_context(case):
+    """
+    Drop the request context Flask-Testing keeps pushed, as streamed bodies
+    are written once the request's own context is gone.
+    """
+    case._ctx.pop()
+    try:
+        yield
+    finally:
+        case._ctx.push()
+
+
+class TestNegotiation(FlaskTestCase):
+
+    """
+    Ensure that request and response bodies are coded as the client asks.
+    """
+
+    def create_app(self):
+        """Create a Flask app"""
+        self.app = Flask(__name__)
+        self.app.config['TESTING'] = True
+        return self.app
+
+    def setUp(self):
+        self.endpoint = DummyEndpoint(object, None, ['a'])
+        self.endpoint.read = lambda path: ['a', 'b'] if path is None else \
+            dict(path=path)
+
+    def test_default(self):
+        Snooze(self.app, codecs=[JSONCodec(), ReprCodec()]).add(self.endpoint)
+        response = self.client.get('/object/foo')
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(response.json, dict(path='foo'))
+
+    def test_accept(self):
+        Snooze(self.app, codecs=[JSONCodec(), ReprCodec()]).add(self.endpoint)
+        response = self.client.get('/object/foo',
+                                   headers={'Accept': 'text/x-repr'})
+        self.assertEqual(response.mimetype, 'text/x-repr')
+        self.assertEqual(response.data, repr(dict(path=u'foo')))
+
+    def test_content_type(self):
+        Snooze(self.app, codecs=[JSONCodec(), ReprCodec()]).add(self.endpoint)
+        data = []
+        self.endpoint.update = lambda path, d: data.append(d)
+        self.client.patch('/object/foo', data=repr(dict(a=1)),
+                          content_type='text/x-repr')
+        self.assertEqual(data, [dict(a=1)])
+
+    def test_stream_fallback(self):
+        Snooze(self.app, codecs=[JSONCodec(), ReprCodec()]).add(self.endpoint)
+        response = self.client.get('/object/?stream=1',
+                                   headers={'Accept': 'text/x-repr'})
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(json.loads(response.data), ['a', 'b'])
+
+        Snooze(self.app, codecs=[ReprCodec(), MsgPackCodec()]).add(
+            self.endpoint, name='t')
+        response = self.client.get('/t/?stream=1',
+                                   headers={'Accept': 'application/msgpack'})
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(json.loads(response.data), ['a', 'b'])
+
+    def test_vary(self):
+        Snooze(self.app, codecs=[JSONCodec(), ReprCodec()]).add(self.endpoint)
+        self.assertIn('Accept', self.client.get('/object/foo').headers['Vary'])
+
+    def test_bulk_ndjson(self):
+        Snooze(self.app, codecs=[JSONCodec(), ReprCodec()]).add(self.endpoint)
+        self.endpoint.write_many = lambda ops: [(201, p) for m, p, d in ops]
+        data_in = '\n'.join(json.dumps(dict(method='DELETE', id=i))
+                            for i in range(3))
+        with no_request_context(self):
+            response = self.client.post('/object/_bulk', data=data_in,
+                                        content_type='application/x-ndjson')
+            results = [json.loads(l) for l in response.data.splitlines()]
+        self.assertEqual([r['id'] for r in results], [0, 1, 2])
+
+    def test_body_cache_variants(self):
+        Snooze(self.app, codecs=[JSONCodec(), ReprCodec()],
+               body_cache=LRUCache()).add(self.endpoint)
+        for i in range(2):
+            self.assertEqual(self.client.get('/object/foo').json,
+                             dict(path='foo'))
+            response = self.client.get('/object/foo',
+                                       headers={'Accept': 'text/x-repr'})
+            self.assertEqual(response.data, repr(dict(path=u'foo')))
+            self.assertEqual(response.mimetype, 'text/x-repr')
+
+    def test_hooks(self):
+        Snooze(self.app, hooks=dict(data_out=repr)).add(self.endpoint)
+        response = self.client.get('/object/foo',
+                                   headers={'Accept': 'application/msgpack'})
+        self.assertEqual(response.data, repr(dict(path=u'foo')))
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        Snooze(self.app).add(self.endpoint)
+        response = self.client.get('/object/foo',
+                                   headers={'Accept': 'application/msgpack'})
+        self.assertEqual(response.mimetype, 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.data, raw=False),
+                         dict(path='foo'))
+
+        data = []
+        self.endpoint.update = lambda path, d: data.append(d)
+        self.client.patch('/object/foo', data=MsgPackCodec().encode(dict(a=1)),
+                          content_type='application/x-msgpack')
+        self.assertEqual(data, [dict(a=1)])
+
+    @skipIf(cbor2 is None, 'cbor2 is not installed')
+    def test_cbor(self):
+        Snooze(self.app).add(self.endpoint)
+        response = self.client.get('/object/?stream=1',
+                                   headers={'Accept': 'application/cbor'})
+        self.assertEqual(response.mimetype, 'application/cbor')
+        self.assertEqual(cbor2.loads(response.data), ['a', 'b'])
+
+        self.endpoint.read = lambda path: dict(on=datetime(2012, 1, 2))
+        response = self.client.get('/object/foo',
+                                   headers={'Accept': 'application/cbor'})
+        self.assertEqual(CBORCodec().decode(response.data)['on'].year, 2012)
+
+
+def gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+class TestCompression(FlaskTestCase):
+
+    """
+    Ensure that responses are compressed as the client accepts.
+    """
+
+    def create_app(self):
+        """Create a Flask app"""
+        self.app = Flask(__name__)
+        self.app.config['TESTING'] = True
+        return self.app
+
+    def setUp(self):
+        self.endpoint = DummyEndpoint(object, None, None)
+        self.reads = []
+        self.big = dict(text=u'x' * 2000)
+
+        def read(path):
+            self.reads.append(path)
+            return [str(i) for i in range(1000)] if path is None else \
+                dict(self.big, path=path)
+        self.endpoint.read = read
+
+    def get(self, url, encoding='gzip'):
+        return self.client.get(url, headers={'Accept-Encoding': encoding})
+
+    def test_gzip(self):
+        Snooze(self.app, compression=Compression(encodings=['gzip'])).add(
+            self.endpoint)
+        response = self.get('/object/foo')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(json.loads(gunzip(response.data)),
+                         dict(self.big, path='foo'))
+
+    def test_refused(self):
+        Snooze(self.app, compression=Compression(encodings=['gzip'])).add(
+            self.endpoint)
+        response = self.get('/object/foo', 'gzip;q=0')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.json, dict(self.big, path='foo'))
+
+    def test_etag(self):
+        Snooze(self.app, compression=Compression()).add(self.endpoint)
+        self.assertEqual(self.get('/object/foo').headers['ETag'],
+                         self.get('/object/foo', 'identity').headers['ETag'])
+
+    def test_min_size(self):
+        Snooze(self.app, compression=Compression(min_size=10000)).add(
+            self.endpoint)
+        response = self.get('/object/foo')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+
+    def test_not_accepted(self):
+        Snooze(self.app, compression=Compression()).add(self.endpoint)
+        response = self.get('/object/foo', 'identity')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.json, dict(self.big, path='foo'))
+
+    def test_error(self):
+        Snooze(self.app, compression=Compression(min_size=0)).add(
+            self.endpoint)
+        self.endpoint.read = lambda path: 1 / 0
+        self.assertNotIn('Content-Encoding', self.get('/object/foo').headers)
+
+    def test_stream(self):
+        Snooze(self.app, compression=Compression(encodings=['gzip'])).add(
+            self.endpoint)
+        response = self.get('/object/?stream=1')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gunzip(response.data)),
+                         sorted(str(i) for i in range(1000)))
+
+    @skipIf(brotli is None, 'brotli is not installed')
+    def test_brotli(self):
+        Snooze(self.app, compression=Compression()).add(self.endpoint)
+        response = self.get('/object/foo', 'gzip, br')
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+        self.assertEqual(json.loads(brotli.decompress(response.data)),
+                         dict(self.big, path='foo'))
+
+    def test_body_cache(self):
+        Snooze(self.app, compression=Compression(encodings=['gzip']),
+               body_cache=LRUCache()).add(self.endpoint)
+        for i in range(2):
+            response = self.get('/object/foo')
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(json.loads(gunzip(response.data)),
+                             dict(self.big, path='foo'))
+            response = self.get('/object/foo', 'identity')
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(response.json, dict(self.big, path='foo'))
+        self.assertEqual(self.reads, ['foo', 'foo'])
+
+
+class TestOptions(FlaskTestCase):
+
+    """
+    Ensure that OPTIONS is answered from the frozen route table, with CORS
+    headers where configured.
+    """
+
+    def create_app(self):
+        """Create a Flask app"""
+        self.app = Flask(__name__)
+        self.app.config['TESTING'] = True
+        return self.app
+
+    def setUp(self):
+        self.endpoint = DummyEndpoint(object, None, None)
+        self.endpoint.read = lambda path: dict(path=path)
+
+    def options(self, url, **headers):
+        return self.client.open(url, method='OPTIONS', headers=headers)
+
+    def test_allow(self):
+        metrics = RecordingMetrics()
+        Snooze(self.app, metrics=metrics).add(self.endpoint,
+                                              methods=('OPTIONS', 'GET'))
+        response = self.options('/object/')
+        self.assert_200(response)
+        self.assertEqual(response.headers['Allow'], 'OPTIONS, GET, HEAD')
+        self.assertEqual(response.json['/object/'], ['OPTIONS', 'GET', 'HEAD'])
+        self.assertEqual(metrics.events, [])
+
+    def test_add_after_freeze(self):
+        mgr = Snooze(self.app)
+        mgr.add(self.endpoint)
+        self.assertNotIn('/thing/', self.options('/object/').json)
+        mgr.add(DummyEndpoint(object, None, None), name='thing')
+        self.assertIn('/thing/', self.options('/object/').json)
+
+    def test_negotiated(self):
+        Snooze(self.app, codecs=[JSONCodec(), ReprCodec()]).add(self.endpoint)
+        self.options('/object/', Accept='text/x-repr')
+        response = self.options('/object/')
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertIn('/object/', response.json)
+
+    def test_preflight(self):
+        Snooze(self.app).add(self.endpoint, methods=('GET',),
+                             cors=CORS(origins=['http://a.example']))
+        response = self.options('/object/foo', Origin='http://a.example')
+        self.assert_200(response)
+        self.assertEqual(response.headers['Access-Control-Allow-Origin'],
+                         'http://a.example')
+        self.assertEqual(response.headers['Access-Control-Allow-Methods'],
+                         'OPTIONS, GET, HEAD')
+        self.assertIn('If-Match',
+                      response.headers['Access-Control-Allow-Headers'])
+        self.assertEqual(response.headers['Vary'], 'Origin')
+
+        response = self.options('/object/foo', Origin='http://b.example')
+        self.assertNotIn('Access-Control-Allow-Origin', response.headers)
+
+    def test_cors_response(self):
+        Snooze(self.app).add(self.endpoint, cors=CORS())
+        response = self.client.get('/object/foo',
+                                   headers={'Origin': 'http://a.example'})
+        self.assertEqual(response.json, dict(path='foo'))
+        self.assertEqual(response.headers['Access-Control-Allow-Origin'], '*')
+        self.assertIn('ETag',
+                      response.headers['Access-Control-Expose-Headers'])
+
+        response = self.client.get('/object/foo')
+        self.assertNotIn('Access-Control-Allow-Origin', response.headers)
+
+    def test_cors_credentials(self):
+        Snooze(self.app).add(self.endpoint, cors=CORS(
+            origins=['http://a.example'], credentials=True))
+        response = self.client.get('/object/foo',
+                                   headers={'Origin': 'http://a.example'})
+        self.assertEqual(response.headers['Access-Control-Allow-Origin'],
+                         'http://a.example')
+        self.assertEqual(
+            response.headers['Access-Control-Allow-Credentials'], 'true')
+
+    def test_cors_credentials_any_origin(self):
+        self.assertRaises(ValueError, CORS, credentials=True)
+
+
+class TestErrors(FlaskTestCase):
+
+    """
+    Ensure that errors are reported without internals unless asked for.
+    """
+
+    def create_app(self):
+        """Create a Flask app"""
+        self.app = Flask(__name__)
+        self.app.config['TESTING'] = True
+        return self.app
+
+    def setUp(self):
+        self.endpoint = DummyEndpoint(object, None, ['a', 'b'])
+        self.endpoint.read = lambda path: 1 / 0
+
+    def test_500(self):
+        Snooze(self.app).add(self.endpoint)
+        response = self.client.get('/object/foo')
+        self.assertStatus(response, 500)
+        self.assertEqual(response.json['type'], 'InternalServerError')
+        self.assertNotIn('detail', response.json)
+
+    def test_500_payload_kept(self):
+        encoded = []
+
+        def data_out(obj):
+            encoded.append(obj)
+            return json.dumps(obj)
+        Snooze(self.app, hooks=dict(data_out=data_out)).add(self.endpoint)
+        self.client.get('/object/foo')
+        response = self.client.get('/object/foo')
+        self.assertStatus(response, 500)
+        self.assertEqual(len(encoded), 1)
+
+    def test_500_debug(self):
+        self.app.debug = True
+        Snooze(self.app).add(self.endpoint)
+        response = self.client.get('/object/foo')
+        self.assertEqual(response.json['type'], 'ZeroDivisionError')
+        self.assertIn('traceback', response.json['detail'])
+
+    def test_500_sampled(self):
+        Snooze(self.app, traceback_rate=1.0).add(self.endpoint)
+        response = self.client.get('/object/foo')
+        self.assertIn('traceback', response.json['detail'])
+
+    def test_validation(self):
+        Snooze(self.app).add(self.endpoint)
+        response = self.client.put('/object/foo',
+                                   data=json.dumps(dict(a=1, c=3)))
+        self.assertStatus(response, 422)
+        self.assertEqual(response.json['type'], 'ValidationError')
+        self.assertEqual(response.json['detail']['errors'],
+                         dict(b='missing', c='not writeable'))
+
+        response = self.client.patch('/object/foo', data=json.dumps(dict(c=3)))
+        self.assertStatus(response, 422)
+
+    def test_bulk_ndjson_failed_chunk(self):
+        Snooze(self.app, chunk_size=2).add(self.endpoint)
+        chunks = []
+
+        def write_many(ops):
+            chunks.append(ops)
+            if len(chunks) == 2:
+                raise IOError('lost the database')
+            return [(200, p) for m, p, d in ops]
+        self.endpoint.write_many = write_many
+
+        data_in = '\n'.join(json.dumps(dict(method='DELETE', id=i))
+                            for i in range(3))
+        with no_request_context(self):
+            response = self.client.post('/object/_bulk', data=data_in,
+                                        content_type='application/x-ndjson')
+            results = [json.loads(l) for l in response.data.splitlines()]
+        self.assertEqual([(r['id'], r['status']) for r in results],
+                         [(0, 200), (1, 200), (2, 500)])
+        self.assertEqual(results[2]['error']['type'], 'InternalServerError')
+
+    def test_bulk_ndjson_undecodable(self):
+        Snooze(self.app, hooks=dict(data_in=lambda d: 1 / 0)).add(
+            self.endpoint)
+        response = self.client.post('/object/_bulk', data='{}\n',
+                                    content_type='application/x-ndjson')
+        self.assertEqual([json.loads(l)['status']
+                          for l in response.data.splitlines()], [400])
+
+    def test_undecodable(self):
+        Snooze(self.app).add(self.endpoint)
+        response = self.client.put('/object/foo', data='{')
+        self.assert_400(response)
+        self.assertEqual(response.json['type'], 'BadRequestError')
+
+    def test_not_a_dict(self):
+        Snooze(self.app).add(self.endpoint)
+        self.assert_400(self.client.put('/object/foo', data='[1, 2]'))
+
+
+class TestSchema(TestCase):
+
+    """
+    Ensure that schemas check and coerce data, reporting every error at once.
+    """
+
+    def setUp(self):
+        self.schema = Schema(dict(n=Field(int, nullable=False),
+                                  x=Field(float),
+                                  d=Field(Decimal),
+                                  s=Field(unicode, max_length=3),
+                                  when=Field(datetime),
+                                  on=Field(date),
+                                  any=Field()))
+        self.data = dict(n=1, x=2, d=u'1.5', s=u'abc',
+                         when=u'2012-01-02T03:04:05+01:00', on=u'2012-01-02',
+                         any=[1])
+
+    def test_coerce(self):
+        self.assertEqual(self.schema.validate(self.data),
+                         dict(n=1, x=2.0, d=Decimal('1.5'), s=u'abc',
+                              when=datetime(2012, 1, 2, 2, 4, 5),
+                              on=date(2012, 1, 2), any=[1]))
+
+    def test_errors(self):
+        self.data.update(n=None, x=True, s=u'abcd', when=u'noon', extra=1)
+        del self.data['on']
+        with self.assertRaises(ValidationError) as cm:
+            self.schema.validate(self.data)
+        self.assertEqual(cm.exception.detail['errors'],
+                         dict(n='may not be null', x='must be a number',
+                              s='must be at most 3 long',
+                              when='must be an ISO 8601 datetime',
+                              on='missing', extra='not writeable'))
+
+    def test_partial(self):
+        self.assertEqual(self.schema.validate(dict(n=2), partial=True),
+                         dict(n=2))
+
+    def test_optional(self):
+        schema = Schema(dict(a=Field(int, nullable=False, required=False)))
+        self.assertEqual(schema.validate({}), {})
+        with self.assertRaises(ValidationError) as cm:
+            schema.validate(dict(a=None))
+        self.assertEqual(cm.exception.detail['errors'],
+                         dict(a='may not be null'))
+
+    def test_custom(self):
+        def upper(v):
+            if not isinstance(v, basestring):
+                raise ValueError('must be text')
+            return v.upper()
+        schema = Schema(dict(a=Field(upper)))
+        self.assertEqual(schema.validate(dict(a=u'x')), dict(a=u'X'))
+        with self.assertRaises(ValidationError) as cm:
+            schema.validate(dict(a=1))
+        self.assertEqual(cm.exception.detail['errors'], dict(a='must be text'))
+
+    def test_endpoint_schema(self):
+        endpoint = DummyEndpoint(object, None, ['a', 'b'])
+        endpoint.schema = lambda: dict(a=Field(int), b=Field())
+        endpoint.compile()
+        with self.assertRaises(ValidationError) as cm:
+            endpoint.validate(dict(a=u'1'))
+        self.assertEqual(cm.exception.detail['errors'],
+                         dict(a='must be an integer', b='missing'))
+
+
+class TestRateLimiter(FlaskTestCase):
+
+    """
+    Ensure that calls beyond the rate allowed are refused.
+    """
+
+    def create_app(self):
+        """Create a Flask app"""
+        self.app = Flask(__name__)
+        self.app.config['TESTING'] = True
+        return self.app
+
+    def setUp(self):
+        self.endpoint = DummyEndpoint(object, None, None)
+
+    def get(self, path='/object/foo', addr='10.0.0.1'):
+        return self.client.get(path, environ_base=dict(REMOTE_ADDR=addr))
+
+    def test_limit(self):
+        limiter = RateLimiter(0.1, burst=2)
+        Snooze(self.app, rate_limit=limiter).add(self.endpoint)
+        self.assert_200(self.get())
+        self.assert_200(self.get())
+        response = self.get()
+        self.assertStatus(response, 429)
+        self.assertEqual(response.json['type'], 'TooManyRequestsError')
+        self.assertIn(response.headers['Retry-After'], ('9', '10'))
+        self.assertEqual(limiter.stats()['limited'], 1)
+        self.assert_200(self.get(addr='10.0.0.2'))
+
+    def test_by_endpoint(self):
+        limiter = RateLimiter(0.1, burst=1, by=('client', 'endpoint'))
+        mgr = Snooze(self.app)
+        mgr.add(self.endpoint, rate_limit=limiter)
+        mgr.add(DummyEndpoint(object, None, None), name='other',
+                rate_limit=limiter)
+        self.assert_200(self.get())
+        self.assert_200(self.get('/other/foo'))
+        self.assertStatus(self.get(), 429)
+
+    def test_by_verb(self):
+        limiter = RateLimiter(0.1, burst=1, by=('verb',))
+        Snooze(self.app).add(self.endpoint, rate_limit=limiter)
+        self.assert_200(self.get())
+        self.assertStatus(self.client.head('/object/foo'), 429)
+        self.assert_200(self.client.delete('/object/foo'))
+
+    def test_disabled(self):
+        limiter = RateLimiter(0.1, burst=1)
+        Snooze(self.app, rate_limit=limiter).add(self.endpoint,
+                                                 rate_limit=False)
+        self.assert_200(self.get())
+        self.assert_200(self.get())
+
+    def test_store(self):
+        store = MemoryRateLimitStore(stripes=1, max_keys=1)
+        self.assertEqual(store.take('a', 100.0, 1.0), 0)
+        self.assertGreater(store.take('a', 100.0, 1.0), 0)
+        time.sleep(0.02)
+        self.assertEqual(store.take('a', 100.0, 1.0), 0)
+        time.sleep(0.02)
+        self.assertEqual(store.take('b', 100.0, 1.0), 0)
+        self.assertEqual(len(store), 1)
+
+    def test_bad_part(self):
+        self.assertRaises(ValueError, RateLimiter, 1, by=('user',))
@@ -2,7 +2,8 @@
 from flask import Flask
 from flask.ext.testing import TestCase as FlaskTestCase
 from flask.ext.sqlalchemy import SQLAlchemy
-from flask.ext.snooze import Snooze, SqlAlchemyEndpoint
+from flask.ext.snooze import Snooze, SqlAlchemyEndpoint, CachedEndpoint, \
+    NotFoundError, LRUCache
 from sqlalchemy.orm import object_mapper
 from datetime import datetime
 import re
@@ -47,7 +48,25 @@ def data_model(db):
                 a = str(a)
             return n, a
 
-    return dict(Book=Book)
+    class Note(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        created = db.Column(db.DateTime(timezone=False), default=datetime.utcnow)
+        text = db.Column(db.String(80))
+
+    class Page(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        version = db.Column(db.Integer, nullable=False)
+        text = db.Column(db.String(80))
+
+        __mapper_args__ = dict(version_id_col=version)
+
+    class Doc(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        rev = db.Column(db.Integer, nullable=False, default=1)
+        count = db.Column(db.Integer, nullable=False, default=0)
+        text = db.Column(db.String(80))
+
+    return dict(Book=Book, Note=Note, Page=Page, Doc=Doc)
 
 
 class TestSnoozeHttp(FlaskTestCase):
@@ -64,7 +83,11 @@ class TestSnoozeHttp(FlaskTestCase):
         return self.app
 
     def setUp(self):
-        self.Book = data_model(self.db)['Book']
+        model = data_model(self.db)
+        self.Book = model['Book']
+        self.Note = model['Note']
+        self.Page = model['Page']
+        self.Doc = model['Doc']
         self.db.create_all()
 
     def create_mgr(self):
@@ -94,7 +117,8 @@ class TestSnoozeHttp(FlaskTestCase):
         """Test a simple POST against the root of the object API"""
         apimgr = self.create_mgr()
         apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']), methods=('POST', 'DELETE'))
-        self.assert_not_4xx(self.client.post('/book/'))
+        self.assert_not_4xx(self.client.post(
+            '/book/', data=json.dumps(dict(title='new'))))
 
     def test_rule_get(self):
         """Test a simple GET"""
@@ -112,7 +136,8 @@ class TestSnoozeHttp(FlaskTestCase):
         """Test a simple PUT"""
         apimgr = self.create_mgr()
         apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
-        self.assert_not_4xx(self.client.put('/book/dummy'))
+        self.assert_not_4xx(self.client.put(
+            '/book/1', data=json.dumps(dict(title='new'))))
 
     def test_rule_patch(self):
         """Test a simple PATCH"""
@@ -163,6 +188,177 @@ class TestSnoozeHttp(FlaskTestCase):
         lst = json.loads(response.data)
         self.assertEqual(set([b.id for b in (b1, b2, b3)]), set(lst))
 
+    def add_books(self, count):
+        books = []
+        for i in range(count):
+            b = self.Book()
+            b.title = 'title %d' % i
+            self.db.session.add(b)
+            books.append(b)
+        self.db.session.commit()
+        return books
+
+    def test_verb_list_paged(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+        ids = sorted(b.id for b in self.add_books(5))
+
+        response = self.client.get('/book/?limit=2')
+        print_tb(response)
+        self.assertEqual(json.loads(response.data), ids[:2])
+        self.assertIn('Link', response.headers)
+        self.assertIn('after=%d' % ids[1], response.headers['Link'])
+        self.assertIn('rel="next"', response.headers['Link'])
+
+        response = self.client.get('/book/?limit=2&after=%d' % ids[3])
+        self.assertEqual(json.loads(response.data), ids[4:])
+        self.assertNotIn('Link', response.headers)
+
+    def test_verb_list_stream(self):
+        apimgr = Snooze(self.app, chunk_size=2)
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+        ids = sorted(b.id for b in self.add_books(5))
+
+        response = self.client.get('/book/?stream=1')
+        self.assertEqual(json.loads(response.data), ids)
+
+        response = self.client.get('/book/?stream=1&limit=3&after=%d' % ids[0])
+        self.assertEqual(json.loads(response.data), ids[1:4])
+
+    def test_verb_list_ids(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+        ids = sorted(b.id for b in self.add_books(3))
+
+        response = self.client.get('/book/?ids=%d,999,%d' % (ids[2], ids[0]))
+        print_tb(response)
+        data = json.loads(response.data)
+        self.assertEqual([d['id'] for d in data], [ids[2], ids[0]])
+        self.assertEqual(data[0]['title'], 'title 2')
+
+    def test_verb_list_expand(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+        ids = sorted(b.id for b in self.add_books(3))
+
+        response = self.client.get('/book/?expand=1')
+        data = json.loads(response.data)
+        self.assertEqual(set(d['id'] for d in data), set(ids))
+
+        response = self.client.get('/book/?expand=1&limit=2')
+        data = json.loads(response.data)
+        self.assertEqual([d['id'] for d in data], ids[:2])
+        self.assertIn('after=%d' % ids[1], response.headers['Link'])
+
+        response = self.client.get('/book/?expand=1&stream=1')
+        data = json.loads(response.data)
+        self.assertEqual([d['title'] for d in data],
+                         ['title 0', 'title 1', 'title 2'])
+
+    def test_verb_list_flags(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+        ids = sorted(b.id for b in self.add_books(3))
+
+        response = self.client.get('/book/?expand=0&stream=false&limit=2')
+        self.assertEqual(json.loads(response.data), ids[:2])
+        self.assertIn('Link', response.headers)
+
+        response = self.client.get('/book/?expand=TRUE&stream=no&limit=2')
+        data = json.loads(response.data)
+        self.assertEqual([d['title'] for d in data], ['title 0', 'title 1'])
+        self.assertIn('Link', response.headers)
+
+    def test_verb_list_filter(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+        ids = sorted(b.id for b in self.add_books(4))
+
+        response = self.client.get('/book/?title=title 1')
+        print_tb(response)
+        self.assertEqual(json.loads(response.data), [ids[1]])
+
+        response = self.client.get('/book/?id__gt=%d&id__lte=%d' % (
+            ids[0], ids[2]))
+        self.assertEqual(json.loads(response.data), ids[1:3])
+
+        response = self.client.get('/book/?id__in=%d,%d&expand=1' % (
+            ids[3], ids[0]))
+        self.assertEqual([d['title'] for d in json.loads(response.data)],
+                         ['title 0', 'title 3'])
+
+        response = self.client.get('/book/?id__gte=%d&limit=2' % ids[1])
+        self.assertEqual(json.loads(response.data), ids[1:3])
+        self.assertIn('id__gte=%d' % ids[1], response.headers['Link'])
+
+    def test_verb_list_filter_datetime(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Note, ['text'],
+                                      filterable_keys=['created']))
+        for day in 1, 2:
+            note = self.Note(text='note', created=datetime(2012, 1, day))
+            self.db.session.add(note)
+        self.db.session.commit()
+
+        response = self.client.get('/note/?created__gt=2012-01-01T12:00')
+        self.assert_200(response)
+        self.assertEqual(len(json.loads(response.data)), 1)
+        self.assert_400(self.client.get('/note/?created__gt=yesterday'))
+
+    def test_verb_list_other_args(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+        ids = sorted(b.id for b in self.add_books(2))
+
+        response = self.client.get('/book/?_=123')
+        self.assertEqual(json.loads(response.data), ids)
+
+    def test_verb_list_expand_paged(self):
+        apimgr = Snooze(self.app, max_expand=2)
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+        ids = sorted(b.id for b in self.add_books(3))
+
+        response = self.client.get('/book/?expand=1')
+        self.assertEqual([d['id'] for d in json.loads(response.data)], ids[:2])
+        self.assertIn('after=%d' % ids[1], response.headers['Link'])
+
+        response = self.client.get('/book/?expand=1&limit=5')
+        self.assertEqual(len(json.loads(response.data)), 2)
+
+        self.assert_400(self.client.get('/book/?ids=%s' % ','.join(
+            str(i) for i in ids)))
+
+    def test_read_many_chunked(self):
+        endpoint = SqlAlchemyEndpoint(self.db, self.Book, ['title'])
+        endpoint.compile()
+        ids = sorted(b.id for b in self.add_books(3))
+        paths = [str(i) for i in range(1000, 2200)] + [str(ids[1])]
+        self.assertEqual([b.id for b in endpoint.read_many(paths)], [ids[1]])
+        self.assertEqual(endpoint.read_partial(paths, ['title']),
+                         [dict(title='title 1')])
+
+    def test_verb_list_sort(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+        ids = sorted(b.id for b in self.add_books(3))
+
+        response = self.client.get('/book/?sort=-title')
+        self.assertEqual(json.loads(response.data), list(reversed(ids)))
+
+        response = self.client.get('/book/?sort=-id&limit=2')
+        self.assertEqual(json.loads(response.data), [ids[2], ids[1]])
+        self.assertNotIn('Link', response.headers)
+
+    def test_verb_list_filter_400(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+
+        self.assert_400(self.client.get('/book/?created=now'))
+        self.assert_400(self.client.get('/book/?title__like=x'))
+        self.assert_400(self.client.get('/book/?id=x'))
+        self.assert_400(self.client.get('/book/?sort=created'))
+        self.assert_400(self.client.get('/book/?sort=id&stream=1'))
+
     def test_verb_post(self):
         apimgr = self.create_mgr()
         apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
@@ -199,6 +395,104 @@ class TestSnoozeHttp(FlaskTestCase):
         self.assertIn('type', data_out)
         self.assertIn('message', data_out)
 
+    def test_verb_bulk(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+        ids = sorted(b.id for b in self.add_books(3))
+
+        data_in = json.dumps([
+            dict(method='POST', data=dict(title='new')),
+            dict(method='PUT', id=999, data=dict(title='put')),
+            dict(method='PUT', id=ids[0], data=dict(title='replaced')),
+            dict(method='PATCH', id=ids[1], data=dict(title='patched')),
+            dict(method='PATCH', id=998, data=dict(title='missing')),
+            dict(method='DELETE', id=ids[2]),
+            dict(method='POST', data=dict(bogus='key')),
+        ])
+        response = self.client.post('/book/_bulk', data=data_in)
+        print_tb(response)
+        self.assert_200(response)
+        results = json.loads(response.data)
+        self.assertEqual([r['status'] for r in results],
+                         [201, 201, 200, 200, 404, 200, 422])
+
+        new_id = results[0]['id']
+        self.assertEqual(self.Book.query.get(new_id).title, 'new')
+        self.assertEqual(self.Book.query.get(999).title, 'put')
+        self.assertEqual(self.Book.query.get(ids[0]).title, 'replaced')
+        self.assertEqual(self.Book.query.get(ids[1]).title, 'patched')
+        self.assertIs(self.Book.query.get(ids[2]), None)
+
+    def test_verb_bulk_order(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+        ids = sorted(b.id for b in self.add_books(2))
+
+        data_in = json.dumps([
+            dict(method='DELETE', id=ids[0]),
+            dict(method='PUT', id=ids[0], data=dict(title='again')),
+            dict(method='POST', id=ids[1], data=dict(title='taken')),
+            dict(method='PATCH', id=ids[0], data=dict(title='patched')),
+            dict(method='DELETE', id=ids[0]),
+            dict(method='POST', id=ids[0], data=dict(title='back')),
+        ])
+        response = self.client.post('/book/_bulk', data=data_in)
+        self.assert_200(response)
+        self.assertEqual([r['status'] for r in json.loads(response.data)],
+                         [200, 201, 409, 200, 200, 201])
+        self.assertEqual(self.Book.query.get(ids[0]).title, 'back')
+        self.assertEqual(self.Book.query.get(ids[1]).title, 'title 1')
+
+    def test_write_many_bad_key(self):
+        endpoint = SqlAlchemyEndpoint(self.db, self.Book, ['title'])
+        self.assertEqual(endpoint.write_many([('DELETE', ['x'], {})]),
+                         [(404, ['x'])])
+
+    def test_verb_bulk_ndjson(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+
+        data_in = '\n'.join(json.dumps(dict(method='PUT',
+                                            id=i,
+                                            data=dict(title='title %d' % i)))
+                            for i in range(1, 4))
+        data_in += '\n{"method": "PUT", "id": 4, "data": '
+        response = self.client.post('/book/_bulk', data=data_in,
+                                    content_type='application/x-ndjson')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        results = [json.loads(l) for l in response.data.splitlines()]
+        self.assertEqual([r['status'] for r in results], [201, 201, 201, 400])
+        self.assertEqual(self.Book.query.count(), 3)
+
+    def test_verb_list_ndjson(self):
+        apimgr = Snooze(self.app, chunk_size=2)
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+        ids = sorted(b.id for b in self.add_books(3))
+        headers = {'Accept': 'application/x-ndjson'}
+
+        response = self.client.get('/book/', headers=headers)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(l) for l in response.data.splitlines()],
+                         ids)
+
+        response = self.client.get('/book/?expand=1&title__in=title 0,title 2',
+                                   headers=headers)
+        self.assertEqual([json.loads(l)['title'] \
+                          for l in response.data.splitlines()],
+                         ['title 0', 'title 2'])
+
+    def test_verb_bulk_rollback(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+
+        data_in = json.dumps([
+            dict(method='PUT', id=1, data=dict(title='same')),
+            dict(method='PUT', id=2, data=dict(title='same')),
+        ])
+        response = self.client.post('/book/_bulk', data=data_in)
+        self.assertEqual(response.status, '500')
+        self.assertEqual(self.Book.query.count(), 0)
+
     def test_verb_get(self):
         apimgr = self.create_mgr()
         apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
@@ -235,6 +529,319 @@ class TestSnoozeHttp(FlaskTestCase):
         self.assertIn('path', data['detail'])
         self.assertEqual(data['detail']['path'], 'dummy')
 
+    def test_verb_get_etag(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+        book_id = self.add_books(1)[0].id
+
+        response = self.client.get('/book/%s' % book_id)
+        self.assert_200(response)
+        self.assertIn('ETag', response.headers)
+        etag = response.headers['ETag']
+
+        response = self.client.get('/book/%s' % book_id,
+                                   headers={'If-None-Match': etag})
+        self.assertStatus(response, 304)
+        self.assertEqual(response.data, '')
+
+        response = self.client.get('/book/%s' % book_id,
+                                   headers={'If-None-Match': '"stale"'})
+        self.assert_200(response)
+
+    def test_verb_get_version_key(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title'],
+                                      version_key='title',
+                                      modified_key='created'))
+        book = self.add_books(1)[0]
+
+        response = self.client.get('/book/%s' % book.id)
+        self.assertEqual(response.headers['ETag'], '"%s"' % book.title)
+        self.assertIn('Last-Modified', response.headers)
+
+        response = self.client.get('/book/%s' % book.id, headers={
+            'If-Modified-Since': response.headers['Last-Modified']})
+        self.assertStatus(response, 304)
+
+    def test_verb_version_moves_on(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Page, ['text'],
+                                      version_key='version'))
+        data_in = json.dumps(dict(text='text'))
+        self.assertStatus(self.client.put('/page/1', data=data_in), 201)
+        etags = [self.client.get('/page/1').headers['ETag']]
+
+        self.assert_200(self.client.patch('/page/1', data=data_in))
+        self.assert_200(self.client.put('/page/1', data=data_in))
+        data_in = json.dumps([dict(method='PATCH', id=1, data=dict(text='t')),
+                              dict(method='PUT', id=2, data=dict(text='t'))])
+        response = self.client.post('/page/_bulk', data=data_in)
+        self.assertEqual([r['status'] for r in json.loads(response.data)],
+                         [200, 201])
+        self.assertEqual(self.Page.query.get(2).version, 1)
+
+        for etag in ['"1"', '"2"', '"3"']:
+            response = self.client.get('/page/1',
+                                       headers={'If-None-Match': etag})
+            self.assert_200(response)
+            etags.append(response.headers['ETag'])
+        self.assertEqual(etags, ['"1"', '"4"', '"4"', '"4"'])
+        self.assertStatus(self.client.get(
+            '/page/1', headers={'If-None-Match': '"4"'}), 304)
+
+    def test_verb_patch_if_match_version(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Doc, ['text'],
+                                      version_key='rev'))
+        data_in = json.dumps(dict(text='text'))
+        self.assertStatus(self.client.put('/doc/1', data=data_in), 201)
+
+        headers = {'If-Match': '"1"'}
+        self.assert_200(self.client.patch('/doc/1', data=data_in,
+                                          headers=headers))
+        self.assertEqual(self.Doc.query.get(1).rev, 2)
+        self.assertStatus(self.client.patch('/doc/1', data=data_in,
+                                            headers=headers), 412)
+        self.assertStatus(self.client.put('/doc/1', data=data_in,
+                                          headers=headers), 412)
+        self.assert_200(self.client.get('/doc/1', headers={
+            'If-None-Match': '"1"'}))
+
+        self.assert_404(self.client.patch('/doc/9', data=data_in,
+                                          headers=headers))
+        self.assertStatus(self.client.put('/doc/9', data=data_in,
+                                          headers=headers), 412)
+
+        self.assert_200(self.client.put('/doc/1', data=data_in,
+                                        headers={'If-Match': '"2"'}))
+        self.assert_200(self.client.patch('/doc/1', data=data_in, headers={
+            'If-Unmodified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'}))
+        self.assertEqual(self.Doc.query.get(1).rev, 4)
+
+    def test_verb_put_race(self):
+        apimgr = self.create_mgr()
+        endpoint = SqlAlchemyEndpoint(self.db, self.Book, ['title'])
+        apimgr.add(endpoint)
+        create = endpoint.create
+
+        def create_raced(path):
+            # NB. another request inserts the row between UPDATE and INSERT
+            endpoint.create = create
+            self.db.session.execute(self.Book.__table__.insert(),
+                                    dict(id=int(path), title='raced'))
+            self.db.session.commit()
+            return create(path)
+        endpoint.create = create_raced
+
+        data_in = json.dumps(dict(title='put'))
+        response = self.client.put('/book/5', data=data_in)
+        self.assert_200(response)
+        self.assertEqual(self.Book.query.get(5).title, 'put')
+
+    def test_verb_put_if_match(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+        book_id = self.add_books(1)[0].id
+        etag = self.client.get('/book/%s' % book_id).headers['ETag']
+
+        data_in = json.dumps(dict(title='new title'))
+        response = self.client.put('/book/%s' % book_id, data=data_in,
+                                   headers={'If-Match': '"stale"'})
+        self.assertStatus(response, 412)
+        self.assertEqual(self.Book.query.get(book_id).title, 'title 0')
+
+        response = self.client.put('/book/%s' % book_id, data=data_in,
+                                   headers={'If-Match': etag})
+        self.assert_200(response)
+        self.assertEqual(self.Book.query.get(book_id).title, 'new title')
+
+    def test_verb_put_if_match_not_existing(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+
+        data_in = json.dumps(dict(title='new title'))
+        response = self.client.put('/book/999', data=data_in,
+                                   headers={'If-Match': '*'})
+        self.assertStatus(response, 412)
+
+    def test_verb_delete_if_match(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+        book_id = self.add_books(1)[0].id
+
+        response = self.client.delete('/book/%s' % book_id,
+                                      headers={'If-Match': '"stale"'})
+        self.assertStatus(response, 412)
+
+    def test_verb_get_cached(self):
+        apimgr = self.create_mgr()
+        endpoint = CachedEndpoint(SqlAlchemyEndpoint(self.db, self.Book,
+                                                     ['title']))
+        apimgr.add(endpoint)
+        book_id = self.add_books(1)[0].id
+
+        self.assertEqual(self.client.get('/book/%s' % book_id).json['title'],
+                         'title 0')
+        self.assertEqual(self.client.get('/book/%s' % book_id).json['title'],
+                         'title 0')
+        self.assertEqual(endpoint.stats()['hits'], 1)
+
+        data_in = json.dumps(dict(title='new title'))
+        self.assert_200(self.client.put('/book/%s' % book_id, data=data_in))
+        self.assertEqual(self.client.get('/book/%s' % book_id).json['title'],
+                         'new title')
+        self.assertEqual(endpoint.stats()['misses'], 2)
+
+    def test_verb_get_cached_padded(self):
+        apimgr = self.create_mgr()
+        endpoint = CachedEndpoint(SqlAlchemyEndpoint(self.db, self.Book,
+                                                     ['title']))
+        apimgr.add(endpoint)
+        book_id = self.add_books(1)[0].id
+
+        self.client.get('/book/0%s' % book_id)
+        data_in = json.dumps(dict(title='new title'))
+        self.assert_200(self.client.patch('/book/%s' % book_id, data=data_in))
+        self.assertEqual(self.client.get('/book/0%s' % book_id).json['title'],
+                         'new title')
+
+    def test_verb_get_body_cached_padded(self):
+        apimgr = Snooze(self.app, body_cache=LRUCache())
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+        book_id = self.add_books(1)[0].id
+
+        self.client.get('/book/0%s' % book_id)
+        data_in = json.dumps(dict(title='new title'))
+        self.assert_200(self.client.patch('/book/%s' % book_id, data=data_in))
+        self.assertEqual(self.client.get('/book/0%s' % book_id).json['title'],
+                         'new title')
+
+    def test_verb_get_columns(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Note, ['text']))
+        note = self.Note()
+        note.text = 'text'
+        self.db.session.add(note)
+        self.db.session.commit()
+
+        response = self.client.get('/note/%s' % note.id)
+        print_tb(response)
+        self.assertEqual(json.loads(response.data), dict(
+            id=note.id,
+            created=note.created.isoformat(),
+            text='text'))
+
+    def test_verb_get_fields(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Note, ['text']))
+        notes = [self.Note(), self.Note()]
+        for i, note in enumerate(notes):
+            note.text = 'text %d' % i
+            self.db.session.add(note)
+        self.db.session.commit()
+        ids = [n.id for n in notes]
+
+        response = self.client.get('/note/%s?fields=text' % ids[0])
+        print_tb(response)
+        self.assertEqual(json.loads(response.data), dict(text='text 0'))
+        self.assertIn('ETag', response.headers)
+
+        response = self.client.get('/note/?ids=%d,%d&fields=id,text' % (
+            ids[1], ids[0]))
+        self.assertEqual(json.loads(response.data), [
+            dict(id=ids[1], text='text 1'),
+            dict(id=ids[0], text='text 0')])
+
+        self.assert_404(self.client.get('/note/999?fields=text'))
+
+    def test_verb_get_fields_iterable(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+        book_id = self.add_books(1)[0].id
+
+        response = self.client.get('/book/%s?fields=title' % book_id)
+        self.assertEqual(json.loads(response.data), dict(title='title 0'))
+
+    def test_serialize_fields(self):
+        endpoint = SqlAlchemyEndpoint(self.db, self.Note, ['text'])
+        endpoint.compile()
+        note = self.Note()
+        note.id = 1
+        note.text = 'text'
+        self.assertEqual(endpoint.serialize(note, ['text']), dict(text='text'))
+        self.assertEqual(endpoint.serialize(note, ['text', 'id']),
+                         dict(id=1, text='text'))
+        self.assertEqual(endpoint.serialize(note, ['bogus']), dict())
+
+        endpoint = SqlAlchemyEndpoint(self.db, self.Book, ['title'])
+        book = self.Book()
+        book.title = 'title'
+        self.assertEqual(endpoint.serialize(book, ['title']),
+                         dict(title='title'))
+
+    def count_queries(self):
+        from sqlalchemy import event
+        queries = []
+        event.listen(self.db.engine, 'before_cursor_execute',
+                     lambda *args: queries.append(args[2]))
+        return queries
+
+    def test_read_identity_map(self):
+        endpoint = SqlAlchemyEndpoint(self.db, self.Book, ['title'])
+        book_id = self.add_books(1)[0].id
+        self.db.session.remove()
+        queries = self.count_queries()
+
+        book = endpoint.read(unicode(book_id))
+        self.assertIs(endpoint.read(unicode(book_id)), book)
+        self.assertEqual(len(queries), 1)
+        self.assertRaises(NotFoundError, endpoint.read, 'dummy')
+        self.assertEqual(len(queries), 1)
+
+    def test_finalize_keeps_key(self):
+        endpoint = SqlAlchemyEndpoint(self.db, self.Book, ['title'])
+        book = self.Book()
+        book.title = 'title'
+        endpoint.finalize(book)
+        queries = self.count_queries()
+        self.assertIsNot(book.id, None)
+        self.assertEqual(queries, [])
+
+    def test_verb_patch_no_select(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+        book_id = self.add_books(1)[0].id
+        queries = self.count_queries()
+
+        data_in = json.dumps(dict(title='new title'))
+        self.assert_200(self.client.patch('/book/%s' % book_id, data=data_in))
+        self.assertEqual([q.split()[0] for q in queries], ['UPDATE'])
+        self.assertEqual(self.Book.query.get(book_id).title, 'new title')
+
+    def test_verb_put_upsert(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+        book_id = self.add_books(1)[0].id
+        queries = self.count_queries()
+
+        data_in = json.dumps(dict(title='new title'))
+        self.assert_200(self.client.put('/book/%s' % book_id, data=data_in))
+        self.assertEqual([q.split()[0] for q in queries], ['UPDATE'])
+
+        del queries[:]
+        response = self.client.put('/book/999', data=data_in.replace('new', 'x'))
+        self.assertStatus(response, 201)
+        self.assertEqual([q.split()[0] for q in queries], ['UPDATE', 'INSERT'])
+
+    def test_verb_delete_commits(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+        book_id = self.add_books(1)[0].id
+
+        self.assert_200(self.client.delete('/book/%s' % book_id))
+        self.db.session.remove()
+        self.assertIs(self.Book.query.get(book_id), None)
+
     def test_verb_head(self):
         apimgr = self.create_mgr()
         apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
@@ -338,3 +945,48 @@ class TestSnoozeHttp(FlaskTestCase):
         put_id = 999
         response = self.client.delete('/book/%s' % put_id)
         self.assert_404(response)
+
+    def test_schema_types(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Book, ['title']))
+
+        response = self.client.put('/book/1', data=json.dumps(dict(title=1)))
+        self.assertStatus(response, 422)
+        self.assertEqual(response.json['detail']['errors'],
+                         dict(title='must be a string'))
+
+        response = self.client.put('/book/1',
+                                   data=json.dumps(dict(title='x' * 81)))
+        self.assertStatus(response, 422)
+        self.assertEqual(response.json['detail']['errors'],
+                         dict(title='must be at most 80 long'))
+
+        response = self.client.put('/book/1',
+                                   data=json.dumps(dict(title=None)))
+        self.assertStatus(response, 422)
+        self.assertEqual(response.json['detail']['errors'],
+                         dict(title='may not be null'))
+
+    def test_schema_defaults(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Doc, ['text', 'count']))
+
+        response = self.client.put('/doc/1', data=json.dumps(dict(text='t')))
+        self.assertStatus(response, 201)
+        self.assertEqual(self.Doc.query.get(1).count, 0)
+
+        response = self.client.patch('/doc/1',
+                                     data=json.dumps(dict(count=None)))
+        self.assertStatus(response, 422)
+        self.assertEqual(response.json['detail']['errors'],
+                         dict(count='may not be null'))
+
+    def test_schema_datetime(self):
+        apimgr = self.create_mgr()
+        apimgr.add(SqlAlchemyEndpoint(self.db, self.Note, ['text', 'created']))
+
+        data_in = json.dumps(dict(text='note', created='2012-01-02T03:04:05Z'))
+        response = self.client.put('/note/1', data=data_in)
+        self.assertStatus(response, 201)
+        note = self.Note.query.filter_by(id=1).first()
+        self.assertEqual(note.created, datetime(2012, 1, 2, 3, 4, 5))